@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of encoding the tests/fixtures/jobA transaction into an envelope.
+
+It compares what GithubClient used to do (sentry_sdk's Envelope serialized into a GzipFile,
+plus building the request headers) with src/envelope.py at a few compression levels, e.g.
+
+    python3 benchmarks/envelope_encoding.py --number 5000
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+from sentry_sdk.envelope import Envelope
+from sentry_sdk.utils import format_timestamp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.envelope import EnvelopeEncoder  # noqa: E402
+
+DSN = "https://foo@random.ingest.sentry.io/1"
+
+
+def sentry_sdk_envelope(trace):
+    envelope = Envelope()
+    envelope.add_transaction(trace)
+    now = datetime.utcnow()
+    headers = {
+        "event_id": trace["event_id"],
+        "sent_at": format_timestamp(now),
+        "Content-Type": "application/x-sentry-envelope",
+        "Content-Encoding": "gzip",
+        "X-Sentry-Auth": f"Sentry sentry_key=foo,"
+        + f"sentry_client=gha-sentry/0.0.1,sentry_timestamp={now},"
+        + "sentry_version=7",
+    }
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode="w") as f:
+        envelope.serialize_into(f)
+    return headers, body.getvalue()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=2000, help="Encodings per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Best of this many runs")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "tests", "fixtures", "jobA", "trace.json")) as f:
+        trace = json.load(f)
+
+    candidates = {"sentry_sdk Envelope + GzipFile": sentry_sdk_envelope}
+    for level in (9, 6, 1, 0):
+        candidates[f"EnvelopeEncoder level {level}"] = EnvelopeEncoder(
+            DSN, level
+        ).encode
+
+    baseline = None
+    print(f"{'':32} {'us/envelope':>12} {'bytes':>7} {'speed-up':>9}")
+    for name, encode in candidates.items():
+        best = min(
+            timeit.repeat(lambda: encode(trace), number=args.number, repeat=args.repeat)
+        )
+        per_call = best / args.number * 1e6
+        baseline = baseline or per_call
+        size = len(encode(trace)[1])
+        print(f"{name:32} {per_call:12.1f} {size:7} {baseline / per_call:8.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,300 @@
+"""
+Load test for the webhook app using local stand-ins for GitHub and Sentry.
+
+It replays signed workflow_job deliveries (based on tests/fixtures/webhook_event.json) at a
+fixed rate and reports latency percentiles, throughput and error rate. The fake GitHub API
+serves the tests/fixtures/jobA run/workflow data with a configurable latency and the fake
+Sentry endpoint accepts envelopes.
+
+By default the app (src.main:app) runs in this process. Use --target to load test an app
+started separately (e.g. with gunicorn); it needs to be started with the environment printed
+by this script, e.g.
+
+    python3 benchmarks/load_test.py --rate 50 --duration 30 --github-latency 0.2
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+WEBHOOK_SECRET = "load-test-secret"
+INSTALLATION_ID = 1
+
+
+def _load_fixture(path):
+    with open(os.path.join(FIXTURES, path)) as f:
+        return json.load(f)
+
+
+def _server(handler_class, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeGitHub(BaseHTTPRequestHandler):
+    latency = 0.0
+    base_url = ""
+    sentry_dsn = ""
+    runs = _load_fixture("jobA/runs.json")
+    workflow = _load_fixture("jobA/workflow.json")
+    requests_count = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        time.sleep(self.latency)
+        FakeGitHub.requests_count += 1
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        # Like GitHub's budget for an installation; it is not reset within a run
+        remaining = max(5000 - FakeGitHub.requests_count, 0)
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", str(remaining))
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if re.fullmatch(r"/app/installations/\d+/access_tokens", self.path):
+            expires_at = datetime.utcnow() + timedelta(hours=1)
+            self._reply(
+                201,
+                {
+                    "token": "fake-token",
+                    "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                },
+            )
+        else:
+            self._reply(404, {"message": "Not Found"})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/.sentry/contents/sentry_config.ini"):
+            config = f"[sentry-github-actions-app]\ndsn = {self.sentry_dsn}\n"
+            self._reply(
+                200,
+                {
+                    "type": "file",
+                    "encoding": "base64",
+                    "content": base64.b64encode(config.encode()).decode(),
+                },
+            )
+        elif match := re.fullmatch(r"/repos/([^/]+/[^/]+)/actions/runs/(\d+)", path):
+            repo, run_id = match.groups()
+            self._reply(
+                200,
+                {
+                    **self.runs,
+                    "id": int(run_id),
+                    "workflow_url": f"{self.base_url}/repos/{repo}/actions/workflows/"
+                    + str(self.runs["workflow_id"]),
+                },
+            )
+        elif re.fullmatch(r"/repos/[^/]+/[^/]+/actions/workflows/\d+", path):
+            self._reply(200, self.workflow)
+        else:
+            self._reply(404, {"message": "Not Found"})
+
+
+class FakeSentry(BaseHTTPRequestHandler):
+    envelopes = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with FakeSentry.lock:
+            FakeSentry.envelopes += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+def _private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def _start_app():
+    # The app reads its configuration when it is imported
+    sys.path.insert(0, ROOT)
+    import logging
+
+    from werkzeug.serving import make_server
+
+    # It logs every request otherwise
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    from src.main import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def _deliveries(github_url, jobs_per_run):
+    """Yield (headers, body) of unique signed deliveries"""
+    event = _load_fixture("webhook_event.json")["payload"]
+    repo = "getsentry/sentry"
+    i = 0
+    while True:
+        run_id = 1_000_000 + i // jobs_per_run
+        payload = {
+            **event,
+            "installation": {"id": INSTALLATION_ID},
+            "workflow_job": {
+                **event["workflow_job"],
+                "id": i,
+                "run_id": run_id,
+                "run_url": f"{github_url}/repos/{repo}/actions/runs/{run_id}",
+            },
+        }
+        body = json.dumps(payload).encode()
+        signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256)
+        headers = {
+            "Content-Type": "application/json",
+            "X-GitHub-Event": "workflow_job",
+            "X-GitHub-Delivery": str(uuid.uuid4()),
+            "X-Hub-Signature-256": f"sha256={signature.hexdigest()}",
+        }
+        yield headers, body
+        i += 1
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[index]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=20, help="Deliveries per second")
+    parser.add_argument("--duration", type=float, default=10, help="In seconds")
+    parser.add_argument(
+        "--github-latency", type=float, default=0.1, help="Seconds per GitHub call"
+    )
+    parser.add_argument("--jobs-per-run", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=30,
+        help="Seconds to wait for acknowledged events to reach Sentry",
+    )
+    parser.add_argument("--target", help="URL of an app started separately")
+    parser.add_argument("--github-port", type=int, default=0)
+    parser.add_argument("--sentry-port", type=int, default=0)
+    args = parser.parse_args()
+
+    sentry = _server(FakeSentry, args.sentry_port)
+    github = _server(FakeGitHub, args.github_port)
+    github_url = f"http://127.0.0.1:{github.server_port}"
+    FakeGitHub.latency = args.github_latency
+    FakeGitHub.base_url = github_url
+    FakeGitHub.sentry_dsn = f"http://key@127.0.0.1:{sentry.server_port}/1"
+
+    env = {
+        "GITHUB_API_URL": github_url,
+        "GH_APP_ID": "1",
+        "GH_APP_PRIVATE_KEY": base64.b64encode(_private_key()).decode(),
+        "GH_WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "LOGGING_LEVEL": "WARNING",
+    }
+    if args.target:
+        target = args.target
+        print("Start the app with this environment:")
+        for key, value in env.items():
+            print(f"  {key}={value}")
+        input("Press enter once it is running...")
+    else:
+        os.environ.update(env)
+        target = _start_app()
+
+    deliveries = _deliveries(github_url, args.jobs_per_run)
+    session = requests.Session()
+    session.mount(
+        "http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    )
+    latencies, statuses, lock = [], {}, threading.Lock()
+
+    def deliver(headers, body):
+        start = time.perf_counter()
+        try:
+            status = session.post(target, data=body, headers=headers, timeout=30)
+            status = status.status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(total):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(deliver, *next(deliveries))
+    elapsed = time.perf_counter() - start
+
+    accepted = statuses.get(200, 0) + statuses.get(202, 0)
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while FakeSentry.envelopes < accepted and time.perf_counter() < drain_deadline:
+        time.sleep(0.1)
+    end_to_end = time.perf_counter() - start
+
+    errors = total - accepted
+    print(f"Deliveries: {total} in {elapsed:.1f}s ({total / elapsed:.1f}/s)")
+    print(f"Responses: {dict(sorted(statuses.items(), key=str))}")
+    print(f"Error rate: {errors / total:.1%}" if total else "Error rate: n/a")
+    for percent in (50, 90, 99):
+        print(f"Latency p{percent}: {percentile(latencies, percent) * 1000:.1f}ms")
+    print(f"Latency max: {max(latencies, default=0) * 1000:.1f}ms")
+    print(
+        f"Envelopes received by Sentry: {FakeSentry.envelopes}/{accepted} "
+        + f"({FakeSentry.envelopes / end_to_end:.1f}/s end to end)"
+    )
+    print(f"GitHub API calls: {FakeGitHub.requests_count}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,39 +3,313 @@
 # This script can be used to ingest a GH job. To ingest a job point it to the URL showing you the log of a job
 # NOTE: Make sure "?check_suite_focus=true" is not included; zsh does not like it
 # For instance https://github.com/getsentry/sentry/runs/5759197422?check_suite_focus=true
+#
+# It can also backfill the history of a repo, e.g. `python3 cli.py backfill getsentry/sentry --days 90`
+# Progress is appended to a checkpoint file, thus, re-running the same command resumes it
+#
+# Transactions written to files (`--sink` or SINK_PATH) can be sent later, e.g.
+# `python3 cli.py replay https://<key>@o1.ingest.sentry.io/<project> ./segments`
 from __future__ import annotations
 
 import argparse
+import json
 import logging
 import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 
 import requests
 
+from src.envelope import get_encoder
+from src.file_sink import FileSink
+from src.file_sink import read_segments
 from src.github_app import GithubAppToken
+from src.github_sdk import cache_workflow_run
 from src.github_sdk import GithubClient
-from src.sentry_config import fetch_dsn_for_github_org
+from src.http_client import GITHUB_API_URL
+from src.http_client import http_client
+from src.rate_limit import rate_limiter
+from src.sampling import job_fields
+from src.sentry_config import fetch_destinations_for_github_org
+from src.spool import get_retry_after
+from src.spool import should_retry
 from src.web_app_handler import WebAppHandler
 
 logging.getLogger().setLevel(os.environ.get("LOGGING_LEVEL", "INFO"))
 logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Keep some of the installation's rate limit for the app serving webhooks
+RATE_LIMIT_RESERVE = 500
+# Listing runs is a search; GitHub returns at most this many results for a query
+SEARCH_RESULTS_LIMIT = 1000
+# Attempts to send a replayed transaction and the first delay between them (in seconds)
+REPLAY_ATTEMPTS = 5
+REPLAY_BACKOFF = 1
 
 
 def _fetch_job(url: str) -> tuple(str, dict):
     _, _, _, org, repo, _, run_id = url.split("?")[0].split("/")
-    req = requests.get(
-        f"https://api.github.com/repos/{org}/{repo}/actions/jobs/{run_id}",
+    req = http_client.get(
+        f"{GITHUB_API_URL}/repos/{org}/{repo}/actions/jobs/{run_id}",
     )
     req.raise_for_status()
     job = req.json()
     return org, job
 
 
-def main() -> int:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("url")
-    parser.add_argument("--installation-id")
-    args = parser.parse_args()
+class Checkpoint:
+    """Runs which have been backfilled; one JSON line is appended after each run"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done: set[str] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["run"])
+                    except ValueError:
+                        # The last line is incomplete if the backfill was interrupted
+                        continue
+
+    @staticmethod
+    def key(run: dict) -> str:
+        return f"{run['id']}:{run['run_attempt']}"
+
+    def __contains__(self, run: dict) -> bool:
+        return self.key(run) in self.done
+
+    def add(self, run: dict) -> None:
+        key = self.key(run)
+        with self._lock:
+            self.done.add(key)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"run": key}) + "\n")
+
+
+class Backfill:
+    def __init__(
+        self,
+        app_token: GithubAppToken,
+        installation_id: int,
+        repo: str,
+        sink: FileSink | None = None,
+    ):
+        self.app_token = app_token
+        self.installation_id = installation_id
+        self.repo = repo
+        # When set, transactions are written to it rather than sent to Sentry
+        self.sink = sink
+        self._rate_limit_lock = threading.Lock()
+        # Cleared while a thread waits for the rate limit to reset; calls wait for it as well
+        self._rate_limit_reset = threading.Event()
+        self._rate_limit_reset.set()
+
+    @property
+    def token(self) -> str:
+        # The token is cached and renewed before it expires
+        return self.app_token.get_installation_token(self.installation_id)
+
+    def _get(self, url: str, params: dict | None = None) -> dict:
+        self._rate_limit_reset.wait()
+        resp = http_client.get(
+            url, params=params, headers={"Authorization": f"token {self.token}"}
+        )
+        if resp.status_code == 401:
+            # The cached token was revoked (e.g. the app was reinstalled); retry once
+            self.app_token.invalidate(self.installation_id)
+            resp = http_client.get(
+                url, params=params, headers={"Authorization": f"token {self.token}"}
+            )
+        # GithubClient paces its own calls with it
+        rate_limiter.update(self.installation_id, resp)
+        resp.raise_for_status()
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        if remaining is not None and int(remaining) < RATE_LIMIT_RESERVE:
+            # Only one thread at a time waits for the rate limit to reset
+            with self._rate_limit_lock:
+                self._rate_limit_reset.clear()
+                try:
+                    delay = max(int(resp.headers["X-RateLimit-Reset"]) - time.time(), 0)
+                    logger.info(
+                        f"Waiting {delay:.0f} seconds for the rate limit to reset."
+                    )
+                    time.sleep(delay)
+                finally:
+                    self._rate_limit_reset.set()
+        return resp.json()
+
+    def _paginate(
+        self, url: str, key: str, params: dict, first_page: dict | None = None
+    ):
+        page = 1
+        data = first_page or self._get(url, {**params, "per_page": 100, "page": page})
+        while True:
+            yield from data[key]
+            if len(data[key]) < 100:
+                return
+            page += 1
+            data = self._get(url, {**params, "per_page": 100, "page": page})
+
+    def runs(self, days: int):
+        # The API returns at most 1,000 runs per query, thus, we list runs one day at a time
+        today = date.today()
+        for offset in range(days):
+            day = today - timedelta(days=offset)
+            start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+            yield from self._runs_created(start, start + timedelta(days=1, seconds=-1))
+
+    def _runs_created(self, start: datetime, end: datetime):
+        """Runs created from start to end (inclusive); busy ranges are split in halves"""
+        url = f"{GITHUB_API_URL}/repos/{self.repo}/actions/runs"
+        params = {
+            "status": "completed",
+            "created": f"{start:%Y-%m-%dT%H:%M:%SZ}..{end:%Y-%m-%dT%H:%M:%SZ}",
+        }
+        first_page = self._get(url, {**params, "per_page": 100, "page": 1})
+        if first_page["total_count"] > SEARCH_RESULTS_LIMIT:
+            if end > start:
+                middle = (start + (end - start) / 2).replace(microsecond=0)
+                yield from self._runs_created(start, middle)
+                yield from self._runs_created(middle + timedelta(seconds=1), end)
+                return
+            logger.warning(
+                f"Only {SEARCH_RESULTS_LIMIT} of the {first_page['total_count']} runs "
+                + f"created at {params['created']} can be listed."
+            )
+        yield from self._paginate(url, "workflow_runs", params, first_page)
+
+    def jobs(self, run: dict):
+        return self._paginate(
+            f"{GITHUB_API_URL}/repos/{self.repo}/actions/runs/{run['id']}"
+            + f"/attempts/{run['run_attempt']}/jobs",
+            "jobs",
+            {},
+        )
+
+    def process_run(self, run: dict, dsn: list[str], checkpoint: Checkpoint) -> None:
+        # This saves fetching the run once per job
+        cache_workflow_run(run)
+        for job in self.jobs(run):
+            client = GithubClient(
+                token=self.token,
+                dsn=dsn,
+                installation_id=self.installation_id,
+                dry_run=self.sink is not None,
+                sink=self.sink,
+            )
+            client.send_trace(job)
+        checkpoint.add(run)
+
+    def run(self, days: int, concurrency: int, checkpoint: Checkpoint) -> int:
+        org, repo = self.repo.split("/")
+        dsn = fetch_destinations_for_github_org(
+            org, self.token, self.installation_id
+        ).for_repo(repo)
+        failures = 0
+
+        def wait(run, future) -> None:
+            nonlocal failures
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                logger.error(f"Failed to backfill run {run['html_url']}: {e}")
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Bounded, thus, the runs of months of history are not all in memory at once
+            in_flight = deque()
+            for run in self.runs(days):
+                if run in checkpoint:
+                    continue
+                in_flight.append(
+                    (run, executor.submit(self.process_run, run, dsn, checkpoint))
+                )
+                if len(in_flight) >= 2 * concurrency:
+                    wait(*in_flight.popleft())
+            for run, future in in_flight:
+                wait(run, future)
+        logger.info(f"Backfilled {len(checkpoint.done)} runs; {failures} failed.")
+        return 1 if failures else 0
+
+
+class Replay:
+    """Sends the transactions of file sink segments (see src/file_sink.py) to a DSN.
+
+    Transactions are streamed in batches; each batch is sent by one thread over the
+    DSN's keep-alive connections while `concurrency` batches are in flight.
+    """
 
+    def __init__(self, dsn: str, concurrency: int = 8, batch_size: int = 100) -> None:
+        self.encoder = get_encoder(dsn)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    def send(self, transaction: dict) -> None:
+        headers, body = self.encoder.encode(transaction)
+        for attempt in range(REPLAY_ATTEMPTS):
+            delay = REPLAY_BACKOFF * 2**attempt
+            try:
+                resp = http_client.post(self.encoder.url, data=body, headers=headers)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if not should_retry(resp.status_code):
+                    resp.raise_for_status()
+                    return
+                error = requests.HTTPError(f"Sentry responded with {resp.status_code}")
+                # Sentry tells us for how long it is rate limiting us
+                delay = get_retry_after(resp) or delay
+            if attempt + 1 < REPLAY_ATTEMPTS:
+                time.sleep(delay)
+        raise error
+
+    def send_batch(self, batch: list[dict]) -> int:
+        """Send the batch and return how many transactions failed"""
+        failures = 0
+        for transaction in batch:
+            try:
+                self.send(transaction)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Failed to replay {transaction['event_id']}: {e}")
+        return failures
+
+    def run(self, paths: list[str]) -> int:
+        sent = failures = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Bounded, thus, segments larger than memory can be replayed
+            in_flight = deque()
+            batch = []
+            for transaction in read_segments(paths):
+                batch.append(transaction)
+                if len(batch) < self.batch_size:
+                    continue
+                in_flight.append((len(batch), executor.submit(self.send_batch, batch)))
+                batch = []
+                if len(in_flight) >= 2 * self.concurrency:
+                    size, future = in_flight.popleft()
+                    failures += future.result()
+                    sent += size
+            if batch:
+                in_flight.append((len(batch), executor.submit(self.send_batch, batch)))
+            for size, future in in_flight:
+                failures += future.result()
+                sent += size
+        logger.info(f"Replayed {sent - failures} transactions; {failures} failed.")
+        return 1 if failures else 0
+
+
+def ingest_job(args, web_app: WebAppHandler) -> int:
     org, job = _fetch_job(args.url)
     if org != "getsentry":
         assert (
@@ -45,13 +319,81 @@ def main() -> int:
     # You can have a default installation ID by using an env variable
     installation_id = args.installation_id or os.environ["INSTALLATION_ID"]
 
-    web_app = WebAppHandler()
     with GithubAppToken(**web_app.config.gh_app._asdict()).get_token(
         installation_id
     ) as token:
-        dsn = fetch_dsn_for_github_org(org, token)
+        dsn = fetch_destinations_for_github_org(org, token).for_repo(
+            job_fields(job)["repo"]
+        )
         client = GithubClient(token=token, dsn=dsn)
         client.send_trace(job)
+    return 0
+
+
+def backfill(args, web_app: WebAppHandler) -> int:
+    installation_id = args.installation_id or os.environ["INSTALLATION_ID"]
+    checkpoint = Checkpoint(
+        args.checkpoint or f".backfill-{args.repo.replace('/', '-')}.jsonl"
+    )
+    sink = FileSink(args.sink) if args.sink else None
+    try:
+        return Backfill(
+            GithubAppToken(**web_app.config.gh_app._asdict()),
+            installation_id,
+            args.repo,
+            sink=sink,
+        ).run(args.days, args.concurrency, checkpoint)
+    finally:
+        if sink:
+            sink.close()
+
+
+def replay(args, web_app: WebAppHandler) -> int:
+    return Replay(args.dsn, args.concurrency, args.batch_size).run(args.paths)
+
+
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    job_parser = subparsers.add_parser("job", help="Ingest a single job")
+    job_parser.add_argument("url")
+    job_parser.add_argument("--installation-id")
+    job_parser.set_defaults(func=ingest_job)
+
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="Ingest the jobs of a repo's past workflow runs"
+    )
+    backfill_parser.add_argument("repo", help="e.g. getsentry/sentry")
+    backfill_parser.add_argument("--installation-id")
+    backfill_parser.add_argument("--days", type=int, default=90)
+    backfill_parser.add_argument("--concurrency", type=int, default=8)
+    backfill_parser.add_argument(
+        "--checkpoint", help="Defaults to .backfill-<org>-<repo>.jsonl"
+    )
+    backfill_parser.add_argument(
+        "--sink",
+        help="Write the transactions to files in this directory rather than sending them",
+    )
+    backfill_parser.set_defaults(func=backfill)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="Send the transactions written by a file sink to a DSN"
+    )
+    replay_parser.add_argument("dsn")
+    replay_parser.add_argument(
+        "paths", nargs="+", help="Segment files or directories with them"
+    )
+    replay_parser.add_argument("--concurrency", type=int, default=8)
+    replay_parser.add_argument("--batch-size", type=int, default=100)
+    replay_parser.set_defaults(func=replay)
+
+    # `cli.py <url>` is a shortcut for `cli.py job <url>`
+    if argv and argv[0] not in subparsers.choices and not argv[0].startswith("-"):
+        argv = ["job", *argv]
+    args = parser.parse_args(argv)
+    return args.func(args, WebAppHandler())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""
+This module contains an asyncio (ASGI) variant of the app in main.py
+
+    uvicorn src.asgi:app --host 0.0.0.0 --port 8080
+
+Each webhook is a coroutine rather than a thread, thus, thousands of them can be in flight
+in one process. The calls to GitHub and Sentry still use the pooled HTTP client (see
+http_client.py) within a thread pool, however, a webhook only holds a thread while one of its
+calls is in progress and independent calls (the org's DSN and the job's run) run concurrently.
+Like main.py, webhooks are responded to once they have been processed, thus, it does not need
+the CPU to be allocated outside of requests (e.g. on Cloud Run).
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+
+import requests
+import sentry_sdk
+from sentry_sdk import capture_exception
+from werkzeug.datastructures import Headers
+
+from .file_sink import create_sink
+from .github_sdk import GithubClient
+from .metrics import DROPPED_EVENTS
+from .metrics import QUEUE_DEPTH
+from .metrics import REGISTRY
+from .metrics import STAGE_DURATION
+from .spool import create_spool
+from .web_app_handler import parse_event
+from .web_app_handler import WebAppHandler
+from src.sentry_config import fetch_destinations_for_github_org
+from src.sentry_config import get_cached_rules
+
+# Threads making the blocking calls of all in-flight webhooks
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 32))
+# Webhooks being processed at once; the app responds with a 503 beyond it
+ASGI_MAX_INFLIGHT = int(os.environ.get("ASGI_MAX_INFLIGHT", 1000))
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWebAppHandler:
+    """WebAppHandler's pipeline as coroutines; the admission checks are the same"""
+
+    def __init__(
+        self,
+        handler: WebAppHandler,
+        executor: ThreadPoolExecutor | None = None,
+        max_inflight: int = ASGI_MAX_INFLIGHT,
+    ) -> None:
+        self.handler = handler
+        self.executor = executor
+        self.max_inflight = max_inflight
+        # Webhooks being processed; they all run on the event loop's thread
+        self.inflight = 0
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def handle_event(self, data, headers) -> tuple[str, int]:
+        reason, http_code, args = self.handler.admit_event(data, headers)
+        if args is None:
+            return reason, http_code
+
+        delivery_id = args[3]
+        if self.inflight >= self.max_inflight:
+            self.handler.seen_deliveries.delete(delivery_id)
+            DROPPED_EVENTS.inc(reason="queue_full")
+            # GitHub will show the delivery as failed and it can be redelivered
+            return "Too many events queued.", 503
+        process = (
+            self.process_workflow_run
+            if self.handler.config.workflow_run_mode
+            else self.process_job
+        )
+        self.inflight += 1
+        try:
+            await process(*args)
+        finally:
+            self.inflight -= 1
+        return reason, http_code
+
+    async def process_job(self, installation_id, org, job, delivery_id=None):
+        def prefetch(token):
+            self.handler.make_client(token, None, installation_id).prefetch_run(job)
+
+        await self._process(
+            installation_id,
+            org,
+            job,
+            delivery_id,
+            lambda client: client.send_trace(job),
+            prefetch,
+        )
+
+    async def process_workflow_run(self, installation_id, org, run, delivery_id=None):
+        await self._process(
+            installation_id,
+            org,
+            run,
+            delivery_id,
+            lambda client: client.send_workflow_run(run),
+        )
+
+    async def _process(
+        self,
+        installation_id,
+        org,
+        event,
+        delivery_id,
+        send: Callable[[GithubClient], Any],
+        prefetch: Callable[[str], None] | None = None,
+    ) -> None:
+        try:
+            with STAGE_DURATION.time(stage="job"):
+                try:
+                    await self._send(installation_id, org, event, send, prefetch)
+                except requests.HTTPError as e:
+                    if not self.handler.invalidate_rejected_token(installation_id, e):
+                        raise
+                    # Once, with a new token
+                    await self._send(installation_id, org, event, send, prefetch)
+        except Exception:
+            # Allow redelivering the event
+            if delivery_id:
+                self.handler.seen_deliveries.delete(delivery_id)
+            raise
+
+    async def _send(
+        self,
+        installation_id,
+        org,
+        event,
+        send: Callable[[GithubClient], Any],
+        prefetch: Callable[[str], None] | None,
+    ) -> None:
+        handler = self.handler
+        token = await self.run(handler.get_token, installation_id)
+        fetch_destinations = self.run(
+            fetch_destinations_for_github_org, org, token, installation_id
+        )
+        # Without the org's rules we do not know yet if the run will be needed
+        rules = get_cached_rules(org, handler.config.workflow_run_mode)
+        if prefetch and rules is not None:
+            destinations, _ = await asyncio.gather(
+                fetch_destinations, self.run(prefetch, token)
+            )
+        else:
+            destinations = await fetch_destinations
+        # The org's rules are cached now if they were not when the event arrived
+        if handler.keep_event(org, event):
+            dsns = destinations.for_repo(handler.event_repo(event))
+            client = handler.make_client(token, dsns, installation_id)
+            await self.run(send, client)
+
+    def close(self) -> None:
+        """Send (or write) what is pending; servers finish in-flight requests before it"""
+        if self.handler.sink:
+            self.handler.sink.close()
+        if self.handler.spool:
+            self.handler.spool.stop()
+
+
+def create_handler() -> AsyncWebAppHandler:
+    if os.environ.get("APP_DSN"):
+        # This tracks errors and performance of the app itself rather than GH workflows
+        sentry_sdk.init(
+            dsn=os.environ["APP_DSN"],
+            traces_sample_rate=float(os.environ.get("APP_TRACES_SAMPLE_RATE", 1.0)),
+            environment=os.environ.get("FLASK_ENV", "production"),
+        )
+    handler = WebAppHandler(
+        spool=create_spool(),
+        background_init=True,
+        sink=create_sink(),
+    )
+    return AsyncWebAppHandler(
+        handler, ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix="asgi")
+    )
+
+
+class ASGIApp:
+    """The same routes as main.py without a web framework.
+
+    The handler is created when the server starts (ASGI's lifespan protocol) unless given.
+    """
+
+    def __init__(self, handler: AsyncWebAppHandler | None = None) -> None:
+        self.handler = handler
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            # Servers which do not support the lifespan protocol
+            if self.handler is None:
+                self._start()
+            status, content_type, body = await self._route(scope, receive)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        (b"content-type", content_type.encode()),
+                        (b"content-length", str(len(body)).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.handler is None:
+                    self._start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.handler.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _start(self) -> None:
+        self.handler = create_handler()
+        QUEUE_DEPTH.set_function(lambda: {("inflight",): self.handler.inflight})
+
+    async def _route(self, scope, receive) -> tuple[int, str, bytes]:
+        path, method = scope["path"], scope["method"]
+        if path == "/metrics":
+            return 200, "text/plain; version=0.0.4", REGISTRY.render().encode()
+        if path == "/ready":
+            if self.handler.handler.ready.is_set():
+                return _json_response(200, "Ready.")
+            return _json_response(503, "Warming up.")
+        if path == "/" and method == "POST":
+            body = await _read_body(receive)
+            headers = Headers(
+                [
+                    (k.decode("latin-1"), v.decode("latin-1"))
+                    for k, v in scope["headers"]
+                ]
+            )
+            with STAGE_DURATION.time(stage="request"):
+                return await self._handle_request(headers, body)
+        return _json_response(404, "Not found.")
+
+    async def _handle_request(self, headers, body: bytes) -> tuple[int, str, bytes]:
+        handler = self.handler.handler
+        # This saves verifying the signature and decoding the payload of deliveries we ignore
+        reason = handler.ignore_reason(headers, body)
+        if reason:
+            return _json_response(200, reason)
+
+        if not handler.valid_signature(body, headers):
+            return _json_response(
+                400,
+                "The secret you are using on your Github webhook does not match this app's secret.",
+            )
+
+        # Top-level crash preventing try block
+        try:
+            reason, http_code = await self.handler.handle_event(
+                parse_event(body), headers
+            )
+            return _json_response(http_code, reason)
+        except Exception as e:
+            logger.exception(e)
+            capture_exception(e)
+            return _json_response(500, "There was an error.")
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def _json_response(status: int, reason: str) -> tuple[int, str, bytes]:
+    return status, "application/json", json.dumps({"reason": reason}).encode()
+
+
+app = ASGIApp()
@@ -0,0 +1,317 @@
+"""
+This module contains the caches: one in memory per process and one shared by processes
+"""
+from __future__ import annotations
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+from .metrics import CACHE_REQUESTS
+
+# SQLite file shared by the app's processes (e.g. gunicorn workers); memory only when unset
+CACHE_PATH = os.environ.get("CACHE_PATH")
+# For how long a process computing a value keeps others from computing it as well
+LEASE_TIMEOUT = 30
+LEASE_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    """A computation in flight which other callers can wait on"""
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: BaseException | None = None
+
+
+class Cache:
+    """Interface of the caches with entries expiring after `ttl` seconds.
+
+    `get_or_set` coalesces concurrent misses for the same key (single-flight),
+    thus, only one caller computes the value while the others wait for it.
+    """
+
+    def __init__(self, ttl: float = 300, name: str | None = None) -> None:
+        # Lookups of named caches are counted in the metrics
+        self.name = name
+        self.ttl = ttl
+        self._inflight: dict[Hashable, _Call] = {}
+        self._inflight_lock = threading.Lock()
+
+    def _lookup(self, key: Hashable) -> tuple[bool, Any]:
+        raise NotImplementedError
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        raise NotImplementedError
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        """Set the value unless the key is present and return whether it was set"""
+        raise NotImplementedError
+
+    def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        found, value = self._lookup(key)
+        if self.name:
+            CACHE_REQUESTS.inc(cache=self.name, result="hit" if found else "miss")
+        if found:
+            return value
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            # The previous leader may have finished between our lookup and now
+            found, call.value = self._lookup(key)
+            if not found:
+                call.value = self._compute(key, func)
+            return call.value
+        except BaseException as e:
+            # Errors are not cached; waiting callers get the same error
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def _compute(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        value = func()
+        self.set(key, value)
+        return value
+
+
+class TTLCache(Cache):
+    """Thread-safe LRU cache in memory"""
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: float = 300, name: str | None = None
+    ) -> None:
+        super().__init__(ttl, name)
+        self.maxsize = maxsize
+        # key -> (expires_at, value)
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _lookup(self, key: Hashable) -> tuple[bool, Any]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: Hashable) -> tuple[bool, Any]:
+        # The caller needs to hold the lock
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, entry[1]
+
+    def _set(self, key: Hashable, value: Any) -> None:
+        # The caller needs to hold the lock
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._set(key, value)
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        with self._lock:
+            found, _ = self._get(key)
+            if not found:
+                self._set(key, value)
+            return not found
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(Cache):
+    """Cache in a SQLite file (WAL mode) shared by the processes of an instance.
+
+    Values are pickled. Besides coalescing misses within the process, a process computing
+    a value holds a lease on its key, thus, the other processes wait for it rather than
+    calling GitHub for the same thing.
+    """
+
+    def __init__(
+        self, path: str, namespace: str, ttl: float = 300, name: str | None = None
+    ) -> None:
+        super().__init__(ttl, name)
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires_at > ?",
+                (self.namespace, time.time()),
+            ).fetchone()[0]
+
+    def _lookup(self, key: Hashable) -> tuple[bool, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (self.namespace, repr(key), time.time()),
+            ).fetchone()
+        return (True, pickle.loads(row[0])) if row else (False, None)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (self.namespace, repr(key), pickle.dumps(value), now + self.ttl),
+            )
+            # Expired entries of this namespace would otherwise pile up
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, now),
+            )
+            self._conn.commit()
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                (self.namespace, repr(key), now),
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO cache (namespace, key, value, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (self.namespace, repr(key), pickle.dumps(value), now + self.ttl),
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, repr(key)),
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ?", (self.namespace,)
+            )
+            self._conn.commit()
+
+    def _compute(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        deadline = time.time() + LEASE_TIMEOUT
+        leased = self._acquire_lease(key)
+        while not leased:
+            time.sleep(LEASE_POLL_INTERVAL)
+            found, value = self._lookup(key)
+            if found:
+                return value
+            if time.time() > deadline:
+                # The process holding the lease is stuck; we cannot wait any longer
+                break
+            leased = self._acquire_lease(key)
+        try:
+            # The previous holder may have stored the value right before releasing the lease
+            found, value = self._lookup(key)
+            if found:
+                return value
+            return super()._compute(key, func)
+        finally:
+            # The lease of another process keeps the others waiting until it expires
+            if leased:
+                self._release_lease(key)
+
+    def _acquire_lease(self, key: Hashable) -> bool:
+        now = time.time()
+        with self._lock:
+            # A lease outlives its process if it crashed, thus, they expire
+            self._conn.execute(
+                "DELETE FROM leases WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                (self.namespace, repr(key), now),
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO leases (namespace, key, expires_at) VALUES (?, ?, ?)",
+                (self.namespace, repr(key), now + LEASE_TIMEOUT),
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def _release_lease(self, key: Hashable) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM leases WHERE namespace = ? AND key = ?",
+                (self.namespace, repr(key)),
+            )
+            self._conn.commit()
+
+
+def make_cache(
+    namespace: str, maxsize: int = 1024, ttl: float = 300, name: str | None = None
+) -> Cache:
+    """A cache shared by the app's processes when CACHE_PATH is set, otherwise in memory"""
+    if CACHE_PATH:
+        return SQLiteCache(CACHE_PATH, namespace, ttl=ttl, name=name)
+    return TTLCache(maxsize=maxsize, ttl=ttl, name=name)
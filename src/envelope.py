@@ -0,0 +1,98 @@
+"""
+This module encodes transactions into Sentry envelopes without sentry_sdk's Envelope objects
+
+An envelope holding one transaction is three lines: the envelope's headers, the item's headers
+and the transaction itself. They are written straight from the transaction dict and compressed
+in one call, while everything which only depends on the DSN is computed once per DSN.
+"""
+from __future__ import annotations
+
+import functools
+import os
+import zlib
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import orjson
+from sentry_sdk.utils import format_timestamp
+
+# gzip level (1-9) of the envelopes sent to Sentry; 0 sends them uncompressed (e.g. to a local Relay)
+ENVELOPE_COMPRESSION_LEVEL = int(os.environ.get("ENVELOPE_COMPRESSION_LEVEL", 6))
+SENTRY_CLIENT = "gha-sentry/0.0.1"
+# zlib writes a gzip header and trailer with this window size
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class EnvelopeEncoder:
+    """Encodes transactions for one DSN"""
+
+    def __init__(
+        self, dsn: str, compression_level: int = ENVELOPE_COMPRESSION_LEVEL
+    ) -> None:
+        if not 0 <= compression_level <= 9:
+            raise ValueError(f"Compression level {compression_level} is not 0-9")
+        self.compression_level = compression_level
+        base_uri, project_id = dsn.rsplit("/", 1)
+        # e.g. https://{KEY}@o1.ingest.sentry.io/{PROJECT_ID} or http:// for a local Relay
+        self.sentry_key = urlsplit(dsn).username
+        # '{BASE_URI}/api/{PROJECT_ID}/{ENDPOINT}/'
+        self.url = f"{base_uri}/api/{project_id}/envelope/"
+        self._auth_prefix = (
+            f"Sentry sentry_key={self.sentry_key},sentry_client={SENTRY_CLIENT},"
+            + "sentry_timestamp="
+        )
+        self._static_headers = {"Content-Type": "application/x-sentry-envelope"}
+        if compression_level:
+            self._static_headers["Content-Encoding"] = "gzip"
+
+    def encode(self, transaction: dict) -> tuple[dict[str, str], bytes]:
+        """The request headers and body of an envelope with the transaction"""
+        return self.headers(transaction), self.compress(serialize(transaction))
+
+    def compress(self, envelope: bytes) -> bytes:
+        if not self.compression_level:
+            return envelope
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(envelope) + compressor.flush()
+
+    def headers(self, transaction: dict) -> dict[str, str]:
+        now = datetime.utcnow()
+        return {
+            "event_id": transaction["event_id"],
+            "sent_at": format_timestamp(now),
+            **self._static_headers,
+            "X-Sentry-Auth": f"{self._auth_prefix}{now},sentry_version=7",
+        }
+
+
+def serialize(transaction: dict) -> bytes:
+    """The uncompressed envelope; it does not depend on the DSN"""
+    payload = orjson.dumps(transaction)
+    item_headers = b'{"type":"transaction","length":%d}' % len(payload)
+    # The envelope has no headers of its own, i.e. "{}"
+    return b"{}\n" + item_headers + b"\n" + payload + b"\n"
+
+
+def encode_for_all(
+    encoders: list[EnvelopeEncoder], transaction: dict
+) -> list[tuple[str, dict[str, str], bytes]]:
+    """The URL, headers and body for each encoder's DSN.
+
+    The transaction is serialized once and compressed once per compression level.
+    """
+    envelope = serialize(transaction)
+    bodies: dict[int, bytes] = {}
+    encoded = []
+    for encoder in encoders:
+        level = encoder.compression_level
+        if level not in bodies:
+            bodies[level] = encoder.compress(envelope)
+        encoded.append((encoder.url, encoder.headers(transaction), bodies[level]))
+    return encoded
+
+
+@functools.lru_cache(maxsize=1024)
+def get_encoder(
+    dsn: str, compression_level: int = ENVELOPE_COMPRESSION_LEVEL
+) -> EnvelopeEncoder:
+    return EnvelopeEncoder(dsn, compression_level)
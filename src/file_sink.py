@@ -0,0 +1,121 @@
+"""
+This module writes the generated transactions to rotating, gzipped NDJSON files (segments)
+
+They can be sent to Sentry later with `python3 cli.py replay`, e.g. for backfills which
+cannot reach Sentry or to resend a day of traffic after an outage without calling GitHub again.
+"""
+from __future__ import annotations
+
+import gzip
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+import orjson
+
+SEGMENT_SUFFIX = ".ndjson.gz"
+# Segments being written; they are renamed once complete, thus, replays skip them
+OPEN_SUFFIX = ".open"
+
+logger = logging.getLogger(__name__)
+
+
+class FileSink:
+    """Appends one transaction per line to gzipped segments in a directory.
+
+    A segment is completed once it holds `max_bytes` of (uncompressed) transactions,
+    when a transaction is written after it has been open for `max_age` seconds or when
+    the sink is closed. Each process writes its own segments.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_age: float = 60 * 60,
+        compression_level: int = 6,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression_level = compression_level
+        self._file: gzip.GzipFile | None = None
+        self._path = ""
+        self._size = 0
+        self._opened_at = 0.0
+        self._segments = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, transaction: dict) -> None:
+        line = orjson.dumps(transaction) + b"\n"
+        with self._lock:
+            if self._file is not None and (
+                self._size >= self.max_bytes
+                or time.monotonic() - self._opened_at >= self.max_age
+            ):
+                self._complete()
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._size += len(line)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._complete()
+
+    def _open(self) -> None:
+        # The caller needs to hold the lock
+        self._segments += 1
+        # e.g. transactions-20220501T120000-42-000001.ndjson.gz; they sort by time
+        name = f"transactions-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._path = os.path.join(
+            self.directory, f"{name}-{self._segments:06d}{SEGMENT_SUFFIX}"
+        )
+        self._file = gzip.GzipFile(
+            self._path + OPEN_SUFFIX, mode="wb", compresslevel=self.compression_level
+        )
+        self._size = 0
+        self._opened_at = time.monotonic()
+
+    def _complete(self) -> None:
+        # The caller needs to hold the lock
+        self._file.close()
+        self._file = None
+        os.replace(self._path + OPEN_SUFFIX, self._path)
+        logger.info(f"Completed segment {self._path} ({self._size} bytes).")
+
+
+def segment_paths(paths: list[str]) -> Iterator[str]:
+    """The given segments plus the completed segments within the given directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(SEGMENT_SUFFIX):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def read_segments(paths: list[str]) -> Iterator[dict]:
+    """Stream the transactions of the segments, one at a time"""
+    for path in segment_paths(paths):
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+
+def create_sink() -> FileSink | None:
+    """The sink writing to SINK_PATH or None when it is not set"""
+    directory = os.environ.get("SINK_PATH")
+    if not directory:
+        return None
+    return FileSink(
+        directory,
+        max_bytes=int(os.environ.get("SINK_SEGMENT_BYTES", 64 * 1024 * 1024)),
+        max_age=float(os.environ.get("SINK_SEGMENT_AGE", 60 * 60)),
+    )
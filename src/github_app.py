@@ -4,50 +4,102 @@ This module contains the logic to support running the app as a Github App
 from __future__ import annotations
 
 import contextlib
+import threading
 import time
+from datetime import datetime
+from datetime import timezone
 from typing import Generator
 
 import jwt
-import requests
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from .cache import make_cache
+from .http_client import GITHUB_API_URL
+from .http_client import http_client
+from .metrics import STAGE_DURATION
+
+# Installation tokens are reused until this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 5 * 60
+# Installation tokens expire after an hour
+TOKEN_LIFETIME = 60 * 60
+# The app's JWT is valid for 5 minutes; we sign a new one a minute before that
+JWT_REFRESH_MARGIN = 60
 
 
 class GithubAppToken:
     def __init__(self, private_key, app_id) -> None:
-        self.headers = self.get_authentication_header(private_key, app_id)
+        # Parsing the PEM file is expensive, thus, we only do it once
+        if isinstance(private_key, str):
+            private_key = private_key.encode()
+        self.private_key = load_pem_private_key(private_key, password=None)
+        self.app_id = app_id
+        # The signed JWT and when it expires as a Unix timestamp
+        self._jwt: tuple[str, int] | None = None
+        self._jwt_lock = threading.Lock()
+        # (app_id, installation_id) -> (token, expires_at as a Unix timestamp)
+        # It can be shared by processes, thus, each token is only minted once per instance
+        self._tokens = make_cache(
+            "tokens", ttl=TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN, name="token"
+        )
 
     # From docs: Installation access tokens have the permissions
     # configured by the GitHub App and expire after one hour.
+    # We keep one token per installation and mint a new one shortly before it expires,
+    # thus, tokens are not revoked after each use.
     @contextlib.contextmanager
     def get_token(self, installation_id: int) -> Generator[str, None, None]:
-        req = requests.post(
-            url=f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-            headers=self.headers,
+        yield self.get_installation_token(installation_id)
+
+    def get_installation_token(self, installation_id: int) -> str:
+        key = (self.app_id, installation_id)
+        token, expires_at = self._tokens.get_or_set(
+            key, lambda: self._timed_mint_token(installation_id)
+        )
+        if expires_at - TOKEN_REFRESH_MARGIN <= time.time():
+            # GitHub can hand out tokens which expire sooner than usual
+            self._tokens.delete(key)
+            token, expires_at = self._tokens.get_or_set(
+                key, lambda: self._timed_mint_token(installation_id)
+            )
+        return token
+
+    def invalidate(self, installation_id: int) -> None:
+        self._tokens.delete((self.app_id, installation_id))
+
+    def _timed_mint_token(self, installation_id: int) -> tuple[str, float]:
+        with STAGE_DURATION.time(stage="token_mint"):
+            return self._mint_token(installation_id)
+
+    def _mint_token(self, installation_id: int) -> tuple[str, float]:
+        req = http_client.post(
+            url=f"{GITHUB_API_URL}/app/installations/{installation_id}/access_tokens",
+            headers=self.get_authentication_header(),
         )
         req.raise_for_status()
         resp = req.json()
-        try:
-            # This token expires in an hour
-            yield resp["token"]
-        finally:
-            requests.delete(
-                "https://api.github.com/installation/token",
-                headers={"Authorization": f"token {resp['token']}"},
-            )
+        # e.g. 2016-07-11T22:14:10Z
+        expires_at = datetime.strptime(resp["expires_at"], "%Y-%m-%dT%H:%M:%SZ")
+        return resp["token"], expires_at.replace(tzinfo=timezone.utc).timestamp()
 
-    def get_jwt_token(self, private_key, app_id):
-        payload = {
-            # issued at time, 60 seconds in the past to allow for clock drift
-            "iat": int(time.time()) - 60,
-            # JWT expiration time (5 minutes maximum)
-            "exp": int(time.time()) + 5 * 60,
-            # GitHub App's identifier
-            "iss": app_id,
-        }
-        return jwt.encode(payload, private_key, algorithm="RS256")
+    def get_jwt_token(self) -> str:
+        # Signing with RS256 is CPU intensive, thus, we reuse the JWT until it is about to expire
+        with self._jwt_lock:
+            now = int(time.time())
+            if self._jwt is None or self._jwt[1] - JWT_REFRESH_MARGIN <= now:
+                payload = {
+                    # issued at time, 60 seconds in the past to allow for clock drift
+                    "iat": now - 60,
+                    # JWT expiration time (5 minutes maximum)
+                    "exp": now + 5 * 60,
+                    # GitHub App's identifier
+                    "iss": self.app_id,
+                }
+                jwt_token = jwt.encode(payload, self.private_key, algorithm="RS256")
+                self._jwt = (jwt_token, payload["exp"])
+            return self._jwt[0]
 
-    def get_authentication_header(self, private_key, app_id):
-        jwt_token = self.get_jwt_token(private_key, app_id)
+    def get_authentication_header(self) -> dict[str, str]:
         return {
             "Accept": "application/vnd.github.v3+json",
-            "Authorization": f"Bearer {jwt_token}",
+            "Authorization": f"Bearer {self.get_jwt_token()}",
         }
@@ -1,21 +1,62 @@
 from __future__ import annotations
 
-import gzip
 import hashlib
-import io
 import logging
+import os
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import requests
-from sentry_sdk.envelope import Envelope
-from sentry_sdk.utils import format_timestamp
+
+from .cache import make_cache
+from .envelope import encode_for_all
+from .envelope import get_encoder
+from .file_sink import FileSink
+from .http_client import http_client
+from .job_logs import generate_log_spans
+from .job_logs import parse_log_groups
+from .metrics import STAGE_DURATION
+from .rate_limit import rate_limiter
+from .spool import EnvelopeSpool
+from .spool import should_retry
+
+# Jobs of the same workflow run complete within seconds of each other (e.g. a matrix),
+# thus, we share the run and workflow objects between them rather than fetching them per job
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 10 * 60))
+_runs_cache = make_cache("runs", maxsize=1024, ttl=METADATA_CACHE_TTL, name="runs")
+_workflows_cache = make_cache(
+    "workflows", maxsize=256, ttl=METADATA_CACHE_TTL, name="workflows"
+)
+
+# Threads sending an envelope to more than one destination at once
+_fanout_executor = ThreadPoolExecutor(
+    int(os.environ.get("FANOUT_THREADS", 16)), thread_name_prefix="fanout"
+)
+
+# Logs can be hundreds of MBs; requests would read them 512 bytes at a time otherwise
+LOG_CHUNK_SIZE = 64 * 1024
+
+# Metadata which is not part of the workflow_job payload and requires calling GitHub's API
+# - author & pull_request: They come from the workflow run
+# - workflow: The workflow's file name (e.g. foo.yml) rather than its name
+ENRICHMENT_FIELDS = frozenset({"author", "pull_request", "workflow"})
 
 
 class GithubSentryError(Exception):
     pass
 
 
+def cache_workflow_run(run):
+    """Store a run fetched elsewhere (e.g. when listing runs) so its jobs do not fetch it again"""
+    _runs_cache.set((run["id"], run["run_attempt"]), run)
+
+
+def clear_metadata_cache():
+    _runs_cache.clear()
+    _workflows_cache.clear()
+
+
 def get_uuid():
     return uuid.uuid4().hex
 
@@ -30,30 +71,76 @@ class GithubClient:
     # This transform GH jobs conclusion keywords to Sentry performance status
     github_status_trace_status = {"success": "ok", "failure": "internal_error"}
 
-    def __init__(self, token, dsn, dry_run=False) -> None:
+    def __init__(
+        self,
+        token,
+        dsn,
+        dry_run=False,
+        enrichment_fields=ENRICHMENT_FIELDS,
+        spool: EnvelopeSpool | None = None,
+        installation_id: int | None = None,
+        max_log_spans: int = 0,
+        sink: FileSink | None = None,
+    ) -> None:
         self.token = token
+        # GitHub's API rate limit is per installation (or per user for PATs)
+        self.rate_limit_key = installation_id or "default"
         self.dry_run = dry_run
-        if dsn:
-            base_uri, project_id = dsn.rsplit("/", 1)
-            self.sentry_key = base_uri.rsplit("@")[0].rsplit("https://")[1]
-            # '{BASE_URI}/api/{PROJECT_ID}/{ENDPOINT}/'
-            self.sentry_project_url = f"{base_uri}/api/{project_id}/envelope/"
+        # Envelopes which Sentry fails to accept are stored here to be retried later
+        self.spool = spool
+        # When set, transactions are also written to files which can be replayed (see cli.py)
+        self.sink = sink
+        # Spans for the groups within each step are generated from the job's log (0 disables it)
+        self.max_log_spans = max_log_spans
+        # Fields worth fetching from the API rather than only using the webhook payload
+        self.enrichment_fields = frozenset(enrichment_fields)
+        # Each trace is sent to every DSN (see sentry_config.Destinations)
+        dsns = [dsn] if isinstance(dsn, str) else list(dsn or [])
+        # Encoders are shared by the clients of the same DSN
+        self.encoders = [get_encoder(dsn) for dsn in dsns]
 
     def _fetch_github(self, url):
         headers = {"Authorization": f"token {self.token}"}
 
-        req = requests.get(url, headers=headers)
+        rate_limiter.acquire(self.rate_limit_key)
+        req = http_client.get(url, headers=headers)
+        rate_limiter.update(self.rate_limit_key, req)
         req.raise_for_status()
         return req
 
-    def _get_extra_metadata(self, job):
+    def _get_enrichment_fields(self):
+        if self.enrichment_fields and rate_limiter.is_low(self.rate_limit_key):
+            # Keep what is left of the budget for the calls we cannot do without
+            return frozenset()
+        return self.enrichment_fields
+
+    def _needs_run(self, job, enrichment_fields):
+        # Older payloads do not include all fields
+        missing = None in (
+            job.get("head_branch"),
+            job.get("head_sha"),
+            job.get("workflow_name"),
+        )
+        return bool(enrichment_fields) or missing
+
+    def _get_run(self, job):
         # XXX: This is the slowest call
-        runs = self._fetch_github(job["run_url"]).json()
-        workflow = self._fetch_github(runs["workflow_url"]).json()
-        repo = runs["repository"]["full_name"]
+        # The run object changes when a job is rerun, thus, the attempt is part of the key
+        return _runs_cache.get_or_set(
+            (job["run_id"], job["run_attempt"]),
+            lambda: self._fetch_github(job["run_url"]).json(),
+        )
+
+    def prefetch_run(self, job):
+        """Cache the job's run ahead of generating its trace (e.g. while fetching the DSN)"""
+        if self._needs_run(job, self._get_enrichment_fields()):
+            self._get_run(job)
+
+    def _get_extra_metadata(self, job):
+        # The workflow_job payload has most of what we need; only a few fields require the API
+        repo = job["run_url"].split("/repos/", 1)[1].rsplit("/actions/", 1)[0]
         meta = {
-            # "workflow_name": workflow["name"],
-            "author": runs["head_commit"]["author"],
+            "author": {},
             # https://getsentry.atlassian.net/browse/TET-22
             # Tags are not linkified externally, plain text data can be selected in browsers and opened
             "data": {
@@ -62,18 +149,43 @@ class GithubClient:
             "tags": {
                 # e.g. success, failure, skipped
                 "job_status": job["conclusion"],
-                "branch": runs["head_branch"],
-                "commit": runs["head_sha"],
+                "branch": job.get("head_branch"),
+                "commit": job.get("head_sha"),
                 "repo": repo,
-                "run_attempt": runs["run_attempt"],  # Rerunning a job
-                # It allows querying jobs within the same workflow (e.g. foo.yml)
-                "workflow": workflow["path"].rsplit("/")[-1],
+                "run_attempt": job["run_attempt"],  # Rerunning a job
+                # Without enrichment this is the workflow's name rather than its file name
+                "workflow": job.get("workflow_name"),
             },
         }
-        if runs.get("pull_requests"):
+        tags = meta["tags"]
+        enrichment_fields = self._get_enrichment_fields()
+        if enrichment_fields != self.enrichment_fields:
+            logging.warning("GitHub's API rate limit is low; skipping enrichment.")
+        if not self._needs_run(job, enrichment_fields):
+            return meta
+
+        runs = self._get_run(job)
+        tags["branch"] = runs["head_branch"]
+        tags["commit"] = runs["head_sha"]
+        if "author" in enrichment_fields:
+            meta["author"] = runs["head_commit"]["author"]
+        if "pull_request" in enrichment_fields and runs.get("pull_requests"):
             pr_number = runs["pull_requests"][0]["number"]
             meta["data"]["pr"] = f"https://github.com/{repo}/pull/{pr_number}"
-            meta["tags"]["pull_request"] = pr_number
+            tags["pull_request"] = pr_number
+        if "workflow" in enrichment_fields:
+            # Newer run objects include the workflow's path, thus, we can skip fetching the workflow
+            path = (
+                runs.get("path")
+                or _workflows_cache.get_or_set(
+                    runs["workflow_id"],
+                    lambda: self._fetch_github(runs["workflow_url"]).json(),
+                )["path"]
+            )
+            # It allows querying jobs within the same workflow (e.g. foo.yml)
+            tags["workflow"] = path.rsplit("/")[-1]
+        elif tags["workflow"] is None:
+            tags["workflow"] = runs["name"]
 
         return meta
 
@@ -81,7 +193,8 @@ class GithubClient:
     # https://docs.sentry.io/product/sentry-basics/tracing/distributed-tracing/#traces
     # https://develop.sentry.dev/sdk/performance/
     def _generate_trace(self, job):
-        meta = self._get_extra_metadata(job)
+        with STAGE_DURATION.time(stage="metadata"):
+            meta = self._get_extra_metadata(job)
         transaction = _base_transaction(job)
         transaction["user"] = meta["author"]
         transaction["tags"] = meta["tags"]
@@ -98,37 +211,191 @@ class GithubClient:
             transaction["contexts"]["trace"]["span_id"],
             transaction["contexts"]["trace"]["trace_id"],
         )
+        if self.max_log_spans:
+            transaction["spans"] += self._generate_log_spans(job, transaction["spans"])
         return transaction
 
+    def _generate_log_spans(self, job, step_spans):
+        # These spans are nice to have, thus, we do not fail the trace if we cannot get them
+        try:
+            rate_limiter.acquire(self.rate_limit_key)
+            # GitHub redirects to the plain text log; we stream it rather than loading it in memory
+            with http_client.get(
+                f"{job['url']}/logs",
+                headers={"Authorization": f"token {self.token}"},
+                stream=True,
+            ) as resp:
+                rate_limiter.update(self.rate_limit_key, resp)
+                resp.raise_for_status()
+                return generate_log_spans(
+                    parse_log_groups(resp.iter_lines(chunk_size=LOG_CHUNK_SIZE)),
+                    step_spans,
+                    self.max_log_spans,
+                )
+        except Exception as e:
+            logging.warning(f"Failed to generate spans from {job['html_url']}: {e}")
+            return []
+
     def _send_envelope(self, trace):
-        if self.dry_run:
+        return self._send_envelopes([trace])
+
+    def _send_envelopes(self, traces):
+        """Send the transactions (e.g. of a run and its jobs) to every destination"""
+        envelopes = []
+        for trace in traces:
+            if self.sink is not None:
+                self.sink.write(trace)
+            if self.dry_run:
+                continue
+            with STAGE_DURATION.time(stage="envelope_serialize"):
+                envelopes += self._serialize_envelope(trace)
+        if len(envelopes) == 1:
+            return self._post_envelope(*envelopes[0])
+        if envelopes:
+            return self._post_envelopes(envelopes)
+
+    def _serialize_envelope(self, trace):
+        return encode_for_all(self.encoders, trace)
+
+    def _post_envelopes(self, envelopes):
+        """Send the envelopes at once and return the first one's response.
+
+        A destination (or transaction) failing does not keep the others from being sent;
+        the first error is raised once they are all done. Redeliveries have the same event
+        ID, thus, Sentry discards the copies it already accepted.
+        """
+        futures = [
+            _fanout_executor.submit(self._post_envelope, *envelope)
+            for envelope in envelopes
+        ]
+        errors = []
+        for (url, _, _), future in zip(envelopes, futures):
+            try:
+                future.result()
+            except Exception as e:
+                parts = urlsplit(url)
+                logging.warning(
+                    f"Failed to send the envelope to {parts.hostname}{parts.path}: {e}"
+                )
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return futures[0].result()
+
+    def _post_envelope(self, url, headers, body):
+        if self.spool is not None and self.spool.is_rate_limited(url):
+            self.spool.add(url, headers, body)
             return
-        envelope = Envelope()
-        envelope.add_transaction(trace)
-        now = datetime.utcnow()
-
-        headers = {
-            "event_id": get_uuid(),  # Does this have to match anything?
-            "sent_at": format_timestamp(now),
-            "Content-Type": "application/x-sentry-envelope",
-            "Content-Encoding": "gzip",
-            "X-Sentry-Auth": f"Sentry sentry_key={self.sentry_key},"
-            + f"sentry_client=gha-sentry/0.0.1,sentry_timestamp={now},"
-            + "sentry_version=7",
-        }
 
-        body = io.BytesIO()
-        with gzip.GzipFile(fileobj=body, mode="w") as f:
-            envelope.serialize_into(f)
+        try:
+            with STAGE_DURATION.time(stage="envelope_send"):
+                req = http_client.post(
+                    url,
+                    data=body,
+                    headers=headers,
+                )
+        except requests.RequestException:
+            if self.spool is None:
+                raise
+            logging.warning("Failed to reach Sentry, the envelope has been spooled.")
+            self.spool.add(url, headers, body)
+            return
 
-        req = requests.post(
-            self.sentry_project_url,
-            data=body.getvalue(),
-            headers=headers,
-        )
+        if self.spool is not None:
+            self.spool.update_rate_limit(url, req)
+            if should_retry(req.status_code):
+                logging.warning(
+                    f"Sentry responded with {req.status_code}, the envelope has been spooled."
+                )
+                self.spool.add(url, headers, body)
+                return req
         req.raise_for_status()
         return req
 
+    def _generate_run_trace(self, run):
+        """The transaction of a workflow run; the transactions of its jobs are its children"""
+        repo = run["repository"]["full_name"]
+        workflow = run["name"]
+        if "workflow" in self.enrichment_fields and run.get("path"):
+            workflow = run["path"].rsplit("/")[-1]
+        transaction = {
+            "event_id": get_uuid_from_string(
+                "workflow_run:"
+                + str(run["id"])
+                + "run_attempt:"
+                + str(run["run_attempt"])
+            ),
+            "type": "transaction",
+            "transaction": run["name"],
+            "contexts": {
+                "trace": {
+                    "span_id": get_uuid()[:16],
+                    # It matches the trace id of the run's jobs (see _base_transaction)
+                    "trace_id": get_uuid_from_string(
+                        "run_id:"
+                        + str(run["id"])
+                        + "run_attempt:"
+                        + str(run["run_attempt"])
+                    ),
+                    "type": "trace",
+                    "op": "workflow_run",
+                    "description": run["name"],
+                    "status": self.github_status_trace_status.get(
+                        run["conclusion"], "unimplemented"
+                    ),
+                    "data": {"run": run["html_url"]},
+                },
+            },
+            "user": (run.get("head_commit") or {}).get("author", {}),
+            "tags": {
+                "run_status": run["conclusion"],
+                "branch": run["head_branch"],
+                "commit": run["head_sha"],
+                "repo": repo,
+                "run_attempt": run["run_attempt"],
+                "workflow": workflow,
+            },
+            "start_timestamp": run["run_started_at"],
+            "timestamp": run["updated_at"],
+            "spans": [],
+        }
+        if run.get("pull_requests"):
+            pr_number = run["pull_requests"][0]["number"]
+            transaction["contexts"]["trace"]["data"][
+                "pr"
+            ] = f"https://github.com/{repo}/pull/{pr_number}"
+            transaction["tags"]["pull_request"] = pr_number
+        return transaction
+
+    def _fetch_run_jobs(self, run):
+        # The jobs of this attempt; later attempts only include the jobs which were rerun
+        url = f"{run['url']}/attempts/{run['run_attempt']}/jobs?per_page=100"
+        while url:
+            resp = self._fetch_github(url)
+            yield from resp.json()["jobs"]
+            url = resp.links.get("next", {}).get("url")
+
+    def send_workflow_run(self, run):
+        """Send a transaction for the run and one for each of its jobs.
+
+        This replaces handling one workflow_job event (and fetching the run) per job.
+        """
+        # Jobs use the run for their metadata, thus, this saves fetching it
+        cache_workflow_run(run)
+        run_trace = self._generate_run_trace(run)
+        traces = [run_trace]
+        for job in self._fetch_run_jobs(run):
+            if job["conclusion"] == "skipped":
+                continue
+            trace = self._generate_trace(job)
+            trace["contexts"]["trace"]["parent_span_id"] = run_trace["contexts"][
+                "trace"
+            ]["span_id"]
+            traces.append(trace)
+        # They are posted at once, thus, a large matrix does not hold up the webhook
+        self._send_envelopes(traces)
+        return traces
+
     def send_trace(self, job):
         # This can happen when the workflow is skipped and there are no steps
         if job["conclusion"] == "skipped":
@@ -143,7 +410,10 @@ class GithubClient:
 
 def _base_transaction(job):
     return {
-        "event_id": get_uuid(),
+        # Redelivered webhooks produce the same event ID, thus, Sentry can discard duplicates
+        "event_id": get_uuid_from_string(
+            "job_id:" + str(job["id"]) + "run_attempt:" + str(job["run_attempt"])
+        ),
         # The distinctive feature of a Transaction is type: "transaction".
         "type": "transaction",
         "transaction": job["name"],
@@ -0,0 +1,128 @@
+"""
+This module contains the HTTP client shared by every outbound call (GitHub and Sentry)
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# It can point to a GitHub Enterprise server or to a local stand-in (see benchmarks/)
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+# Connections kept alive per host; it should match the number of threads making requests
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 16))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 10))
+# A host is not called for CIRCUIT_RESET_TIMEOUT seconds after this many consecutive failures
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """The host has been failing, thus, we fail fast rather than waiting on it"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let one request through to probe the host
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    """Keep-alive connection pools with default timeouts and a circuit breaker per host"""
+
+    def __init__(
+        self,
+        pool_size: int = HTTP_POOL_SIZE,
+        timeout: tuple[float, float] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+    ) -> None:
+        self.timeout = timeout
+        self.session = requests.Session()
+        # requests keeps a pool per host; pool_connections is how many hosts it keeps pools for
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def circuit_breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(
+                    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+                )
+            return self._breakers[host]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._breakers.clear()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        host = urlsplit(url).hostname
+        breaker = self.circuit_breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Too many failures calling {host}.")
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            raise
+        if resp.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return resp
+
+    def warm(self, url: str, connections: int = 1) -> None:
+        """Open connections to the url's host ahead of the first request.
+
+        This moves the DNS lookup and the TCP and TLS handshakes out of the first webhook.
+        The requests are concurrent HEADs, thus, each opens its own connection; they are
+        unauthenticated and do not count against the app's rate limit.
+        """
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(self.head, url) for _ in range(connections)]
+            for future in futures:
+                future.result()
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+http_client = HttpClient()
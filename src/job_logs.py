@@ -0,0 +1,96 @@
+"""
+This module turns a job's log into spans for the groups within each step.
+
+Logs can be hundreds of MBs, thus, they are parsed line by line as they are downloaded.
+"""
+from __future__ import annotations
+
+import uuid
+from datetime import datetime
+from datetime import timezone
+from typing import Iterable
+from typing import Iterator
+from typing import NamedTuple
+
+# Groups come from the workflow's runner (e.g. the inputs of a step) or from
+# `echo "::group::name"` within a step, which shows up as "##[group]name"
+GROUP_MARKER = "##[group]"
+END_GROUP_MARKER = "##[endgroup]"
+
+
+class LogGroup(NamedTuple):
+    name: str
+    start_timestamp: str
+    timestamp: str
+
+
+def parse_timestamp(value: str) -> datetime:
+    # Logs have 7 fractional digits (e.g. 2022-04-06T19:52:17.1234567Z) while steps have 3
+    value = value.rstrip("Z")
+    seconds, _, fraction = value.partition(".")
+    parsed = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S")
+    return parsed.replace(
+        microsecond=int(fraction[:6].ljust(6, "0")), tzinfo=timezone.utc
+    )
+
+
+def parse_log_groups(lines: Iterable[str | bytes]) -> Iterator[LogGroup]:
+    """Yield the groups of a log, only keeping the group which is open in memory"""
+    current: tuple[str, str] | None = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        # e.g. 2022-04-06T19:52:17.1234567Z ##[group]Run actions/checkout@v2
+        timestamp, _, message = line.lstrip("\ufeff").partition(" ")
+        if message.startswith(GROUP_MARKER):
+            current = (message[len(GROUP_MARKER) :].strip(), timestamp)
+        elif message.startswith(END_GROUP_MARKER) and current is not None:
+            yield LogGroup(current[0], current[1], timestamp)
+            current = None
+
+
+def generate_log_spans(
+    groups: Iterable[LogGroup], step_spans: list[dict], max_spans: int
+) -> list[dict]:
+    """Spans for the groups which happened within a step, as children of that step's span.
+
+    It stops consuming `groups` once `max_spans` have been generated.
+    """
+    steps = [
+        (
+            parse_timestamp(span["start_timestamp"]),
+            parse_timestamp(span["timestamp"]),
+            span,
+        )
+        for span in step_spans
+        # Steps which never ran (e.g. skipped or cancelled) have no timestamps
+        if span["start_timestamp"] and span["timestamp"]
+    ]
+    spans = []
+    for group in groups:
+        started_at = parse_timestamp(group.start_timestamp)
+        for step_start, step_end, step in steps:
+            # Step timestamps are rounded to the second
+            if (
+                step_start.replace(microsecond=0)
+                <= started_at
+                <= step_end.replace(microsecond=999999)
+            ):
+                # The runner shows each step's command as a group; it adds nothing to the step
+                if group.name != step["name"]:
+                    spans.append(
+                        {
+                            "op": "group",
+                            "name": group.name,
+                            "description": group.name,
+                            "parent_span_id": step["span_id"],
+                            "span_id": uuid.uuid4().hex[:16],
+                            "start_timestamp": group.start_timestamp,
+                            "timestamp": group.timestamp,
+                            "trace_id": step["trace_id"],
+                        }
+                    )
+                break
+        if len(spans) >= max_spans:
+            break
+    return spans
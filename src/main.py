@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import atexit
 import logging
 import os
+import signal
+import threading
 
 import sentry_sdk
 from flask import abort
@@ -11,20 +14,20 @@ from flask import request
 from sentry_sdk import capture_exception
 from sentry_sdk.integrations.flask import FlaskIntegration
 
+from .file_sink import create_sink
+from .metrics import QUEUE_DEPTH
+from .metrics import RATE_LIMIT_REMAINING
+from .metrics import REGISTRY
+from .metrics import STAGE_DURATION
+from .rate_limit import rate_limiter
+from .spool import create_spool
+from .startup import process_uptime
+from .startup import startup_profile
+from .web_app_handler import parse_event
 from .web_app_handler import WebAppHandler
-
-APP_DSN = os.environ.get("APP_DSN")
-if APP_DSN:
-    # This tracks errors and performance of the app itself rather than GH workflows
-    sentry_sdk.init(
-        dsn=APP_DSN,
-        integrations=[FlaskIntegration()],
-        # Set traces_sample_rate to 1.0 to capture 100%
-        # of transactions for performance monitoring.
-        # We recommend adjusting this value in production.
-        traces_sample_rate=1.0,
-        environment=os.environ.get("FLASK_ENV", "production"),
-    )
+from .worker_pool import OVERFLOW_REJECT
+from .worker_pool import parse_weights
+from .worker_pool import WorkerPool
 
 LOGGING_LEVEL = os.environ.get("LOGGING_LEVEL", "INFO")
 # Set the logging level for all loggers (e.g. requests)
@@ -36,13 +39,132 @@ logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 logger.info("App logging is working.")
 
-handler = WebAppHandler()
+# Time from the process starting (e.g. gunicorn forking the worker) until the imports are done
+startup_profile.record("imports", process_uptime())
+
+APP_DSN = os.environ.get("APP_DSN")
+if APP_DSN:
+    # This tracks errors and performance of the app itself rather than GH workflows
+    with startup_profile.step("sentry_sdk"):
+        sentry_sdk.init(
+            dsn=APP_DSN,
+            integrations=[FlaskIntegration()],
+            # 1.0 captures 100% of transactions for performance monitoring
+            traces_sample_rate=float(os.environ.get("APP_TRACES_SAMPLE_RATE", 1.0)),
+            environment=os.environ.get("FLASK_ENV", "production"),
+        )
+
+# When set, webhooks are acknowledged right away and processed by this pool of threads.
+# On Cloud Run it needs the CPU to be always allocated (see setup.md).
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 0))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 1000))
+# Events of one installation processed at once, either by the pool or within requests
+INSTALLATION_MAX_CONCURRENCY = int(os.environ.get("INSTALLATION_MAX_CONCURRENCY", 0))
+# How long to wait for queued events to be processed when shutting down
+WORKER_DRAIN_TIMEOUT = float(os.environ.get("WORKER_DRAIN_TIMEOUT", 8))
+
+worker_pool = None
+if WORKER_POOL_SIZE > 0:
+    worker_pool = WorkerPool(
+        size=WORKER_POOL_SIZE,
+        queue_size=WORKER_QUEUE_SIZE,
+        # Installations take turns; e.g. "12345:4" serves that one 4 times as often
+        weights=parse_weights(os.environ.get("INSTALLATION_WEIGHTS", "")),
+        max_concurrency=INSTALLATION_MAX_CONCURRENCY,
+        key_queue_size=int(os.environ.get("INSTALLATION_QUEUE_SIZE", 0)),
+        overflow=os.environ.get("QUEUE_OVERFLOW", OVERFLOW_REJECT),
+    )
+
+    # Cloud Run sends SIGTERM before stopping an instance; drain before gunicorn's handler runs
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.getsignal(signal.SIGTERM)
+
+        def drain_on_sigterm(signum, frame):
+            worker_pool.shutdown(WORKER_DRAIN_TIMEOUT)
+            if callable(previous_handler):
+                previous_handler(signum, frame)
+            else:
+                raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, drain_on_sigterm)
+
+# Envelopes which Sentry fails to accept are stored in the SQLite file at SPOOL_PATH and retried
+with startup_profile.step("spool"):
+    spool = create_spool()
+
+# Transactions are also written to rotating files within SINK_PATH, if set
+sink = create_sink()
+
+
+def shutdown():
+    # The queued events feed the other components, thus, they are drained first
+    if worker_pool:
+        worker_pool.shutdown(WORKER_DRAIN_TIMEOUT)
+    if sink:
+        sink.close()
+    # Envelopes failing while the others are flushed are still spooled
+    if spool:
+        spool.stop()
+
+
+atexit.register(shutdown)
+
+# The private key is loaded in the background; /ready tells when it is done
+with startup_profile.step("handler"):
+    handler = WebAppHandler(
+        worker_pool=worker_pool,
+        spool=spool,
+        background_init=True,
+        sink=sink,
+        installation_max_concurrency=INSTALLATION_MAX_CONCURRENCY,
+    )
+
+
+def queue_depths():
+    depths = {}
+    if worker_pool:
+        depths[("worker",)] = worker_pool.qsize()
+    if spool:
+        depths[("spool",)] = len(spool)
+    return depths
+
+
+QUEUE_DEPTH.set_function(queue_depths)
+RATE_LIMIT_REMAINING.set_function(
+    lambda: {
+        (str(installation),): remaining
+        for installation, remaining in rate_limiter.remaining().items()
+    }
+)
 
 app = Flask(__name__)
 
 
+@app.route("/metrics")
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+# Point Cloud Run's startup probe here, thus, traffic is only routed to warm instances
+@app.route("/ready")
+def ready():
+    if handler.ready.is_set():
+        return jsonify({"reason": "Ready."}), 200
+    return jsonify({"reason": "Warming up."}), 503
+
+
 @app.route("/", methods=["POST"])
 def main():
+    with STAGE_DURATION.time(stage="request"):
+        return handle_request()
+
+
+def handle_request():
+    # This saves verifying the signature and decoding the payload of deliveries we ignore
+    reason = handler.ignore_reason(request.headers, request.data)
+    if reason:
+        return jsonify({"reason": reason}), 200
+
     if not handler.valid_signature(request.data, request.headers):
         abort(
             400,
@@ -51,7 +173,9 @@ def main():
 
     # Top-level crash preventing try block
     try:
-        reason, http_code = handler.handle_event(request.json, request.headers)
+        reason, http_code = handler.handle_event(
+            parse_event(request.data), request.headers
+        )
         return jsonify({"reason": reason}), http_code
     except Exception as e:
         logger.exception(e)
@@ -0,0 +1,208 @@
+"""
+This module contains the app's metrics, exposed in Prometheus' text format on /metrics
+"""
+from __future__ import annotations
+
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Generator
+from typing import Tuple
+
+# In seconds; they cover from cache hits to slow GitHub calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}",
+                *self.samples(),
+            ]
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Its values are read when rendering from a function returning {label values: value}"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._functions: list[Callable[[], Dict[Labels, float]]] = []
+
+    def set_function(self, func: Callable[[], Dict[Labels, float]]) -> None:
+        with self._lock:
+            self._functions.append(func)
+
+    def samples(self) -> list[str]:
+        values: dict[Labels, float] = {}
+        with self._lock:
+            functions = list(self._functions)
+        for func in functions:
+            values.update(func())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket with +Inf last, sum)
+        self._values: dict[Labels, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([], 0))
+        return sum(counts)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# Stages: request, job, token_mint, dsn_fetch, metadata, envelope_serialize, envelope_send
+STAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "gha_stage_duration_seconds",
+        "Time spent in each stage of processing a webhook.",
+        ["stage"],
+    )
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "gha_cache_requests_total",
+        "Cache lookups by cache (token, dsn, runs, workflows) and result.",
+        ["cache", "result"],
+    )
+)
+RETRIES = REGISTRY.register(
+    Counter(
+        "gha_envelope_retries_total",
+        "Attempts to deliver spooled envelopes by status.",
+        ["status"],
+    )
+)
+DROPPED_EVENTS = REGISTRY.register(
+    Counter(
+        "gha_dropped_events_total",
+        "Events or envelopes we gave up on by reason.",
+        ["reason"],
+    )
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("gha_queue_depth", "Items waiting to be processed per queue.", ["queue"])
+)
+RATE_LIMIT_REMAINING = REGISTRY.register(
+    Gauge(
+        "gha_github_rate_limit_remaining",
+        "GitHub API calls left per installation.",
+        ["installation"],
+    )
+)
@@ -0,0 +1,155 @@
+"""
+This module paces calls to GitHub's API per installation using the rate limit headers
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Hashable
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Below this fraction of the hourly budget we skip calls which only enrich traces
+RATE_LIMIT_DEGRADE_RATIO = float(os.environ.get("RATE_LIMIT_DEGRADE_RATIO", 0.1))
+# For how long a call waits for budget before giving up
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 5))
+# GitHub asks to wait at least a minute when a rate limit response has no Retry-After
+RATE_LIMITED_WAIT = 60
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class Budget:
+    """An installation's remaining calls until the limit resets.
+
+    Calls go through while there is plenty left; below RATE_LIMIT_DEGRADE_RATIO of the
+    limit they are spread evenly until the reset, thus, the budget is not exhausted early.
+    """
+
+    def __init__(self, limit: int, remaining: int, reset_at: float) -> None:
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_at = reset_at
+        # Set when GitHub asks us to back off (secondary rate limits)
+        self.blocked_until = 0.0
+        # When the next call can be made while the budget is low
+        self.next_call_at = 0.0
+
+    def refill(self, now: float) -> None:
+        if now >= self.reset_at:
+            # GitHub has reset the budget although we have not seen it yet
+            self.remaining = self.limit
+            self.reset_at = now + 60 * 60
+            self.next_call_at = 0.0
+
+    def is_low(self) -> bool:
+        return self.remaining < self.limit * RATE_LIMIT_DEGRADE_RATIO
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a call can be made"""
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.remaining < 1:
+            return self.reset_at - now
+        if not self.is_low():
+            return 0
+        return max(self.next_call_at - now, 0)
+
+    def consume(self, now: float) -> None:
+        self.remaining -= 1
+        if self.is_low():
+            self.next_call_at = now + (self.reset_at - now) / max(self.remaining, 1)
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self._budgets: dict[Hashable, Budget] = {}
+        self._lock = threading.Lock()
+
+    def remaining(self) -> dict[Hashable, int]:
+        """Calls left per installation as last reported by GitHub"""
+        with self._lock:
+            return {key: budget.remaining for key, budget in self._budgets.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._budgets.clear()
+
+    def is_low(self, key: Hashable) -> bool:
+        """Whether calls which only enrich traces should be skipped"""
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None:
+                return False
+            now = time.time()
+            budget.refill(now)
+            return budget.blocked_until > now or budget.is_low()
+
+    def acquire(self, key: Hashable, max_wait: float = RATE_LIMIT_MAX_WAIT) -> None:
+        """Wait for budget to make a call or raise RateLimitExceeded"""
+        deadline = time.time() + max_wait
+        while True:
+            with self._lock:
+                budget = self._budgets.get(key)
+                if budget is None:
+                    return
+                now = time.time()
+                budget.refill(now)
+                wait = budget.wait_time(now)
+                if wait == 0:
+                    budget.consume(now)
+                    return
+            if now + wait > deadline:
+                raise RateLimitExceeded(
+                    f"No GitHub API budget left for {key} in the next {max_wait}s."
+                )
+            time.sleep(wait)
+
+    def update(self, key: Hashable, resp: requests.Response) -> None:
+        headers = resp.headers
+        with self._lock:
+            budget = self._budgets.get(key)
+            if "X-RateLimit-Remaining" in headers:
+                limit = int(headers.get("X-RateLimit-Limit", 5000))
+                remaining = int(headers["X-RateLimit-Remaining"])
+                reset_at = float(headers.get("X-RateLimit-Reset", time.time() + 3600))
+                if budget is None:
+                    budget = self._budgets[key] = Budget(limit, remaining, reset_at)
+                else:
+                    budget.limit = limit
+                    budget.remaining = remaining
+                    budget.reset_at = reset_at
+            wait = rate_limited_wait(resp)
+            if wait:
+                if budget is None:
+                    # The budget is unknown; only the wait applies
+                    budget = self._budgets[key] = Budget(5000, 5000, time.time() + 3600)
+                budget.blocked_until = time.time() + wait
+                logger.warning(f"GitHub asked us to wait {wait}s ({key}).")
+
+
+def rate_limited_wait(resp: requests.Response) -> float:
+    """Seconds GitHub asks us to wait before the next call or 0 if it did not"""
+    if resp.status_code not in (403, 429):
+        return 0
+    # Secondary rate limits usually come with a Retry-After header
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        return float(retry_after)
+    # Other 403s are permission errors
+    if (
+        resp.status_code == 429
+        or resp.headers.get("X-RateLimit-Remaining") == "0"
+        or "secondary rate limit" in resp.text.lower()
+    ):
+        return RATE_LIMITED_WAIT
+    return 0
+
+
+rate_limiter = RateLimiter()
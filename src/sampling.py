@@ -0,0 +1,132 @@
+"""
+This module contains the sampling and drop rules orgs can add to their sentry_config.ini
+
+    [sentry-github-actions-app.rule.dependabot]
+    workflow = dependabot*
+    sample_rate = 0
+
+    [sentry-github-actions-app.rule.feature-branches]
+    repo = sentry, relay
+    branch = !master
+    sample_rate = 0.1
+
+Each key is a comma separated list of shell-style patterns matched against the job (or run);
+a rule applies when all of its keys match and the first rule that applies decides.
+"""
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import logging
+import re
+from configparser import ConfigParser
+from typing import NamedTuple
+
+RULE_SECTION_PREFIX = "sentry-github-actions-app.rule."
+FIELDS = ("repo", "workflow", "job", "branch", "event", "conclusion")
+# Only known for workflow runs since job payloads do not include them
+RUN_ONLY_FIELDS = frozenset({"event"})
+
+logger = logging.getLogger(__name__)
+
+
+class Rule(NamedTuple):
+    name: str
+    # field -> (compiled patterns, whether the match is negated)
+    patterns: dict[str, tuple[re.Pattern, bool]]
+    sample_rate: float
+
+    def matches(self, fields: dict[str, str | None]) -> bool:
+        for field, (pattern, negated) in self.patterns.items():
+            value = fields.get(field)
+            if value is None or bool(pattern.match(value)) == negated:
+                return False
+        return True
+
+
+class Rules:
+    """Rules compiled once per org, thus, evaluating them is only a few regex matches"""
+
+    def __init__(self, rules: list[Rule] | None = None) -> None:
+        self.rules = rules or []
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    @classmethod
+    def from_config(cls, cp: ConfigParser, workflow_run_mode: bool = False) -> Rules:
+        rules = []
+        for section in cp.sections():
+            if not section.startswith(RULE_SECTION_PREFIX):
+                continue
+            name = section[len(RULE_SECTION_PREFIX) :]
+            try:
+                rules.append(
+                    compile_rule(name, dict(cp.items(section)), workflow_run_mode)
+                )
+            except ValueError as e:
+                # A typo in one rule should not stop the org's events from being ingested
+                logger.warning(f"Ignoring rule {name}: {e}")
+        return cls(rules)
+
+    def keep(self, fields: dict[str, str | None], sample_key: str) -> bool:
+        """Whether the job (or run) should be ingested according to the first matching rule"""
+        for rule in self.rules:
+            if rule.matches(fields):
+                return sample(sample_key, rule.sample_rate)
+        return True
+
+
+def compile_rule(
+    name: str, options: dict[str, str], workflow_run_mode: bool = False
+) -> Rule:
+    sample_rate = float(options.pop("sample_rate", 0))
+    if not 0 <= sample_rate <= 1:
+        raise ValueError(f"sample_rate {sample_rate} is not between 0 and 1")
+    unknown = set(options) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"unknown keys {sorted(unknown)}")
+    run_only = set(options) & RUN_ONLY_FIELDS
+    if run_only and not workflow_run_mode:
+        # Otherwise, the rule would never match a job
+        raise ValueError(f"{sorted(run_only)} only apply in workflow_run mode")
+    patterns = {field: compile_patterns(value) for field, value in options.items()}
+    return Rule(name, patterns, sample_rate)
+
+
+def compile_patterns(value: str) -> tuple[re.Pattern, bool]:
+    """Compile a comma separated list of shell-style patterns; a leading ! negates them"""
+    value = value.strip()
+    negated = value.startswith("!")
+    alternatives = [p.strip() for p in value.lstrip("!").split(",") if p.strip()]
+    regex = "|".join(fnmatch.translate(pattern) for pattern in alternatives)
+    return re.compile(regex), negated
+
+
+def sample(sample_key: str, sample_rate: float) -> bool:
+    # Deterministic, thus, redeliveries of an event get the same decision
+    digest = hashlib.sha256(sample_key.encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < sample_rate
+
+
+def job_fields(job: dict) -> dict[str, str | None]:
+    return {
+        # e.g. https://api.github.com/repos/getsentry/sentry/actions/runs/2104746951
+        "repo": job["run_url"].split("/repos/", 1)[1].split("/")[1],
+        "workflow": job.get("workflow_name"),
+        "job": job.get("name"),
+        "branch": job.get("head_branch"),
+        "event": None,
+        "conclusion": job.get("conclusion"),
+    }
+
+
+def run_fields(run: dict) -> dict[str, str | None]:
+    return {
+        "repo": run["repository"]["name"],
+        "workflow": run.get("name"),
+        "job": None,
+        "branch": run.get("head_branch"),
+        "event": run.get("event"),
+        "conclusion": run.get("conclusion"),
+    }
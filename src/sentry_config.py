@@ -1,25 +1,188 @@
 from __future__ import annotations
 
 import base64
+import functools
+import logging
+import os
+import re
 from configparser import ConfigParser
-from functools import lru_cache
+from typing import NamedTuple
 
-import requests
+from .cache import make_cache
+from .http_client import GITHUB_API_URL
+from .http_client import http_client
+from .metrics import CACHE_REQUESTS
+from .metrics import STAGE_DURATION
+from .rate_limit import rate_limiter
+from .sampling import compile_patterns
+from .sampling import Rules
 
 SENTRY_CONFIG_API_URL = (
-    "https://api.github.com/repos/{owner}/.sentry/contents/sentry_config.ini"
+    GITHUB_API_URL + "/repos/{owner}/.sentry/contents/sentry_config.ini"
 )
+# For how long (in seconds) we trust a cached DSN before revalidating it with GitHub
+DSN_CACHE_TTL = int(os.environ.get("DSN_CACHE_TTL", 5 * 60))
 
 
-def fetch_dsn_for_github_org(org: str, token: str) -> str:
+# For how long the last fetched config is kept to revalidate it rather than fetching it again
+CONFIG_CACHE_TTL = 24 * 60 * 60
+DESTINATION_SECTION_PREFIX = "sentry-github-actions-app.destination."
+
+logger = logging.getLogger(__name__)
+
+
+class Destination(NamedTuple):
+    name: str
+    dsn: str
+    # Compiled repo patterns and whether the match is negated; None matches every repo
+    repos: tuple[re.Pattern, bool] | None = None
+
+    def matches(self, repo: str | None) -> bool:
+        if self.repos is None:
+            return True
+        pattern, negated = self.repos
+        return repo is not None and bool(pattern.match(repo)) != negated
+
+
+class Destinations:
+    """Projects an org's jobs are sent to besides the one of its `dsn`, e.g.
+
+    [sentry-github-actions-app.destination.team-a]
+    dsn = https://...@o1.ingest.sentry.io/2
+    repo = sentry, relay*
+    """
+
+    def __init__(self, dsn: str, destinations: list[Destination] | None = None) -> None:
+        self.dsn = dsn
+        self.destinations = destinations or []
+
+    @classmethod
+    def from_config(cls, dsn: str, cp: ConfigParser) -> Destinations:
+        destinations = []
+        for section in cp.sections():
+            if not section.startswith(DESTINATION_SECTION_PREFIX):
+                continue
+            name = section[len(DESTINATION_SECTION_PREFIX) :]
+            if not cp.has_option(section, "dsn"):
+                # A typo in one destination should not stop the others from getting events
+                logger.warning(f"Ignoring destination {name}: it has no dsn")
+                continue
+            repos = cp.get(section, "repo", fallback=None)
+            destinations.append(
+                Destination(
+                    name,
+                    cp.get(section, "dsn"),
+                    compile_patterns(repos) if repos else None,
+                )
+            )
+        return cls(dsn, destinations)
+
+    def for_repo(self, repo: str | None) -> list[str]:
+        """The DSNs a job (or run) of the repo is sent to; the org's `dsn` goes first"""
+        dsns = [self.dsn]
+        for destination in self.destinations:
+            if destination.matches(repo) and destination.dsn not in dsns:
+                dsns.append(destination.dsn)
+        return dsns
+
+
+class CachedDsn(NamedTuple):
+    dsn: str
+    etag: str | None
+    # The contents of sentry_config.ini
+    config: str = ""
+
+    @property
+    def destinations(self) -> Destinations:
+        return parse_destinations(self.dsn, self.config)
+
+
+# Fresh DSNs; they can be shared by processes (see make_cache)
+_dsn_cache = make_cache("dsn", maxsize=1024, ttl=DSN_CACHE_TTL, name="dsn")
+# The last fetched config of each org, thus, it can be revalidated with its ETag
+_config_cache = make_cache("sentry_config", maxsize=1024, ttl=CONFIG_CACHE_TTL)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_rules(config: str, workflow_run_mode: bool = False) -> Rules:
+    """The sampling and drop rules of a config; they are compiled once per process"""
+    cp = ConfigParser()
+    cp.read_string(config)
+    return Rules.from_config(cp, workflow_run_mode)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_destinations(dsn: str, config: str) -> Destinations:
+    cp = ConfigParser()
+    cp.read_string(config)
+    return Destinations.from_config(dsn, cp)
+
+
+def invalidate_dsn_cache(org: str | None = None) -> None:
+    """Forget the DSN of an org (or of all orgs), e.g. after a push to its .sentry repo"""
+    if org is None:
+        _dsn_cache.clear()
+        _config_cache.clear()
+    else:
+        # The config is kept; revalidating it is free if the file did not change
+        _dsn_cache.delete(org)
+
+
+def get_cached_rules(org: str, workflow_run_mode: bool = False) -> Rules | None:
+    """The org's rules without making any request or None if its config is not fresh.
+
+    Only the config of a fresh DSN is trusted; after a push to the .sentry repo (or once
+    the DSN expires) the event is checked again once the config has been revalidated.
+    """
+    cached = _dsn_cache.get(org)
+    return parse_rules(cached.config, workflow_run_mode) if cached else None
+
+
+def fetch_dsn_for_github_org(
+    org: str, token: str, installation_id: int | None = None
+) -> str:
+    # Concurrent misses for the same org are coalesced into one request
+    return _dsn_cache.get_or_set(
+        org, lambda: _timed_fetch_dsn(org, token, installation_id)
+    ).dsn
+
+
+def fetch_destinations_for_github_org(
+    org: str, token: str, installation_id: int | None = None
+) -> Destinations:
+    """Like fetch_dsn_for_github_org plus the org's other destinations (same cache)"""
+    return _dsn_cache.get_or_set(
+        org, lambda: _timed_fetch_dsn(org, token, installation_id)
+    ).destinations
+
+
+def _timed_fetch_dsn(org: str, token: str, installation_id: int | None) -> CachedDsn:
+    with STAGE_DURATION.time(stage="dsn_fetch"):
+        return _fetch_dsn(org, token, installation_id, _config_cache.get(org))
+
+
+def _fetch_dsn(
+    org: str, token: str, installation_id: int | None, cached: CachedDsn | None
+) -> CachedDsn:
+
     # Using the GH app token allows fetching the file in a private repo
     headers = {
         "Accept": "application/vnd.github+json",
         "Authorization": f"token {token}",
     }
+    if cached and cached.etag:
+        # A 304 response does not count against the rate limit
+        headers["If-None-Match"] = cached.etag
     api_url = SENTRY_CONFIG_API_URL.replace("{owner}", org)
     # - Get meta about sentry_config.ini file
-    resp = requests.get(api_url, headers=headers)
+    rate_limit_key = installation_id or "default"
+    rate_limiter.acquire(rate_limit_key)
+    resp = http_client.get(api_url, headers=headers)
+    rate_limiter.update(rate_limit_key, resp)
+    if cached and resp.status_code == 304:
+        CACHE_REQUESTS.inc(cache="dsn", result="revalidated")
+        _config_cache.set(org, cached)
+        return cached
     resp.raise_for_status()
     meta = resp.json()
 
@@ -33,4 +196,7 @@ def fetch_dsn_for_github_org(org: str, token: str) -> str:
     # - Read ini file and assertions
     cp = ConfigParser()
     cp.read_string(file_contents)
-    return cp.get("sentry-github-actions-app", "dsn")
+    dsn = cp.get("sentry-github-actions-app", "dsn")
+    cached = CachedDsn(dsn, resp.headers.get("ETag"), file_contents)
+    _config_cache.set(org, cached)
+    return cached
@@ -0,0 +1,204 @@
+"""
+This module keeps envelopes which could not be delivered to Sentry on disk and retries them
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from .http_client import http_client
+from .metrics import DROPPED_EVENTS
+from .metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Exponential backoff between attempts; it starts at BACKOFF_BASE seconds
+BACKOFF_BASE = 10
+BACKOFF_MAX = 60 * 60
+# Envelopes older than this are given up on
+MAX_AGE = 24 * 60 * 60
+# Used when Sentry rate limits us without telling us for how long
+DEFAULT_RETRY_AFTER = 60
+
+
+def should_retry(status_code: int) -> bool:
+    # Other client errors (e.g. 400, 413) will fail the same way if retried
+    return status_code == 429 or status_code >= 500
+
+
+def get_retry_after(resp: requests.Response) -> float | None:
+    """Seconds Sentry wants us to wait before sending transactions again, if any"""
+    # e.g. "60:transaction;error:organization, 2700::key" where no categories means all of them
+    # https://develop.sentry.dev/sdk/rate-limiting/
+    rate_limits = resp.headers.get("X-Sentry-Rate-Limits")
+    if rate_limits:
+        delays = []
+        for limit in rate_limits.split(","):
+            retry_after, categories, *_ = limit.strip().split(":") + [""]
+            if not categories or "transaction" in categories.split(";"):
+                try:
+                    delays.append(float(retry_after))
+                except ValueError:
+                    delays.append(DEFAULT_RETRY_AFTER)
+        if delays:
+            return max(delays)
+    if resp.headers.get("Retry-After"):
+        try:
+            return float(resp.headers["Retry-After"])
+        except ValueError:
+            return DEFAULT_RETRY_AFTER
+    if resp.status_code == 429:
+        return DEFAULT_RETRY_AFTER
+    return None
+
+
+class EnvelopeSpool:
+    """Append-only SQLite (WAL mode) store of envelopes pending delivery.
+
+    A background thread retries them with exponential backoff while honouring
+    Sentry's rate limits per destination.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 5) -> None:
+        self.path = path
+        self.poll_interval = poll_interval
+        # Destination URL -> Unix timestamp until which we cannot send to it
+        self.rate_limited_until: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS envelopes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM envelopes").fetchone()[0]
+
+    def is_rate_limited(self, url: str) -> bool:
+        return self.rate_limited_until.get(url, 0) > time.time()
+
+    def update_rate_limit(self, url: str, resp: requests.Response) -> None:
+        retry_after = get_retry_after(resp)
+        if retry_after:
+            self.rate_limited_until[url] = time.time() + retry_after
+
+    def add(
+        self, url: str, headers: dict[str, str], body: bytes, delay: float = 0
+    ) -> None:
+        now = time.time()
+        next_attempt = max(now + delay, self.rate_limited_until.get(url, 0))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO envelopes (url, headers, body, next_attempt, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(headers), body, next_attempt, now),
+            )
+            self._conn.commit()
+
+    def drain(self, limit: int = 100) -> int:
+        """Try to deliver the envelopes which are due and return how many were delivered"""
+        now = time.time()
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM envelopes WHERE created_at < ?", (now - MAX_AGE,)
+            ).rowcount
+            if expired:
+                DROPPED_EVENTS.inc(expired, reason="spool_expired")
+            rows = self._conn.execute(
+                "SELECT id, url, headers, body, attempts FROM envelopes"
+                " WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self._conn.commit()
+
+        delivered = 0
+        for row_id, url, headers, body, attempts in rows:
+            if self.is_rate_limited(url):
+                self._reschedule(row_id, attempts, self.rate_limited_until[url])
+                continue
+            try:
+                resp = http_client.post(url, data=body, headers=json.loads(headers))
+            except requests.RequestException as e:
+                RETRIES.inc(status="error")
+                logger.warning(f"Failed to deliver spooled envelope: {e}")
+                self._reschedule(row_id, attempts + 1)
+                continue
+
+            RETRIES.inc(status=resp.status_code)
+            self.update_rate_limit(url, resp)
+            if resp.ok:
+                delivered += 1
+                self._delete(row_id)
+            elif should_retry(resp.status_code):
+                self._reschedule(
+                    row_id, attempts + 1, self.rate_limited_until.get(url, 0)
+                )
+            else:
+                DROPPED_EVENTS.inc(reason="rejected_by_sentry")
+                logger.error(
+                    f"Dropping spooled envelope rejected by Sentry ({resp.status_code})."
+                )
+                self._delete(row_id)
+        return delivered
+
+    def _reschedule(self, row_id: int, attempts: int, not_before: float = 0) -> None:
+        backoff = min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE envelopes SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts, max(time.time() + backoff, not_before), row_id),
+            )
+            self._conn.commit()
+
+    def _delete(self, row_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM envelopes WHERE id = ?", (row_id,))
+            self._conn.commit()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="spool", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                # Keep going while there is a backlog
+                while self.drain() and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                logger.exception(e)
+
+
+def create_spool() -> EnvelopeSpool | None:
+    """The spool at SPOOL_PATH, already retrying envelopes, or None when it is not set"""
+    path = os.environ.get("SPOOL_PATH")
+    if not path:
+        return None
+    spool = EnvelopeSpool(path)
+    spool.start()
+    return spool
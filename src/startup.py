@@ -0,0 +1,75 @@
+"""
+This module measures how long each component of the app takes to start
+"""
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Generator
+
+from .metrics import Gauge
+from .metrics import REGISTRY
+
+# Log each component's start up time as it completes
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "").lower() in ("1", "true")
+logger = logging.getLogger(__name__)
+
+STARTUP_DURATION = REGISTRY.register(
+    Gauge(
+        "gha_startup_duration_seconds",
+        "Time spent importing or initializing each component when the app started.",
+        ["component"],
+    )
+)
+
+
+def process_uptime() -> float | None:
+    """Seconds since this process started or None where /proc is not available.
+
+    It covers what happens before our code runs (e.g. the interpreter and imports).
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The process name can contain spaces; the fields we want come after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    # starttime is the 22nd field of stat, counted in clock ticks since boot
+    return system_uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class StartupProfile:
+    def __init__(self, enabled: bool = STARTUP_PROFILE) -> None:
+        self.enabled = enabled
+        # component -> seconds, in the order they were recorded
+        self.durations: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def step(self, component: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(component, time.perf_counter() - start)
+
+    def record(self, component: str, duration: float | None) -> None:
+        if duration is None:
+            return
+        with self._lock:
+            self.durations[component] = duration
+        if self.enabled:
+            logger.info(f"Startup: {component} took {duration * 1000:.1f}ms")
+
+    def samples(self) -> dict[tuple[str, ...], float]:
+        with self._lock:
+            return {(component,): value for component, value in self.durations.items()}
+
+
+startup_profile = StartupProfile()
+STARTUP_DURATION.set_function(startup_profile.samples)
@@ -2,65 +2,333 @@ from __future__ import annotations
 
 import base64
 import hmac
+import json
 import logging
 import os
+import re
+import threading
 from typing import NamedTuple
 
+import requests
+
+from .cache import TTLCache
+from .file_sink import FileSink
 from .github_app import GithubAppToken
+from .github_sdk import ENRICHMENT_FIELDS
 from .github_sdk import GithubClient
-from src.sentry_config import fetch_dsn_for_github_org
+from .http_client import GITHUB_API_URL
+from .http_client import http_client
+from .metrics import DROPPED_EVENTS
+from .metrics import STAGE_DURATION
+from .sampling import job_fields
+from .sampling import run_fields
+from .spool import EnvelopeSpool
+from .startup import process_uptime
+from .startup import startup_profile
+from .worker_pool import WorkerPool
+from src.sentry_config import fetch_destinations_for_github_org
+from src.sentry_config import get_cached_rules
+from src.sentry_config import invalidate_dsn_cache
 
 LOGGING_LEVEL = os.environ.get("LOGGING_LEVEL", logging.INFO)
+# GitHub serializes the action first, e.g. {"action":"queued","workflow_job":{...
+ACTION_RE = re.compile(rb'\A\s*\{\s*"action"\s*:\s*"([^"]*)"')
+# GitHub allows redelivering webhooks from the last few days
+DELIVERY_CACHE_TTL = int(os.environ.get("DELIVERY_CACHE_TTL", 24 * 60 * 60))
+DELIVERY_CACHE_SIZE = int(os.environ.get("DELIVERY_CACHE_SIZE", 50_000))
+# How long events wait for the app to finish warming up before failing
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", 30))
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGGING_LEVEL)
 
 
 class WebAppHandler:
-    def __init__(self, dry_run=False):
-        self.config = init_config()
+    def __init__(
+        self,
+        dry_run=False,
+        worker_pool: WorkerPool | None = None,
+        spool: EnvelopeSpool | None = None,
+        background_init: bool = False,
+        sink: FileSink | None = None,
+        installation_max_concurrency: int = 0,
+    ):
+        # Loading the Github App's private key can take seconds, thus, it can be deferred
+        self.config = init_config(load_gh_app=not background_init)
         self.dry_run = dry_run
+        self.spool = spool
+        self.sink = sink
+        # X-GitHub-Delivery IDs of the events we have already processed
+        self.seen_deliveries = TTLCache(
+            maxsize=DELIVERY_CACHE_SIZE, ttl=DELIVERY_CACHE_TTL
+        )
+        # When set, events are processed in the background after acknowledging the webhook
+        self.worker_pool = worker_pool
+        # Events of one installation processed at once without the pool; 0 means no limit
+        self.installation_max_concurrency = installation_max_concurrency
+        self._installation_inflight: dict = {}
+        self._installation_lock = threading.Lock()
+        # It caches installation tokens, thus, it needs to live as long as the app
+        self.gh_app_token: GithubAppToken | None = None
+        # Set once events can be processed without waiting on the initialization
+        self.ready = threading.Event()
+        if background_init:
+            threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+        else:
+            self._init_gh_app_token()
+            self.ready.set()
+
+    def warm_up(self) -> None:
+        """Load the Github App's private key and open connections to GitHub.
+
+        This runs after the app starts listening, thus, instances come up sooner
+        and the first webhook does not pay for the handshakes.
+        """
+        try:
+            self.config = self.config._replace(gh_app=load_gh_app_config())
+            self._init_gh_app_token()
+            if self.gh_app_token:
+                with startup_profile.step("sign JWT"):
+                    self.gh_app_token.get_jwt_token()
+            with startup_profile.step("warm HTTP pool"):
+                http_client.warm(GITHUB_API_URL)
+        except Exception as e:
+            # Events can still be processed; connections will be opened when used
+            logger.exception(e)
+        finally:
+            self.ready.set()
+            startup_profile.record("ready", process_uptime())
+
+    def _init_gh_app_token(self) -> None:
+        if not self.config.gh_app:
+            return
+        try:
+            with startup_profile.step("parse private key"):
+                self.gh_app_token = GithubAppToken(**self.config.gh_app._asdict())
+        except Exception as e:
+            logger.exception(e)
+            logger.warning("The private key is not valid, thus, we will use the PAT.")
+            self.config = self.config._replace(gh_app=None)
+
+    @property
+    def trace_event(self) -> str:
+        # In workflow run mode all jobs of a run are ingested at once, thus, job events are ignored
+        return "workflow_run" if self.config.workflow_run_mode else "workflow_job"
+
+    def ignore_reason(self, headers, body: bytes) -> str | None:
+        """Why we can ignore this delivery by only looking at its headers and start of the body.
+
+        Most deliveries are events (or workflow_job states) we do nothing with, thus,
+        we can reply to them before verifying the signature and decoding the payload.
+        """
+        event = headers.get("X-GitHub-Event")
+        if event not in ("push", self.trace_event):
+            return "Event not supported."
+        if event == self.trace_event:
+            action = peek_action(body)
+            if action is not None and action != "completed":
+                return "We cannot do anything with this workflow state."
+        return None
 
     def handle_event(self, data, headers):
+        reason, http_code, args = self.admit_event(data, headers)
+        if args is None:
+            return reason, http_code
+
+        installation_id, org, _, delivery_id = args
+        process = (
+            self.process_workflow_run
+            if self.config.workflow_run_mode
+            else self.process_job
+        )
+        if self.worker_pool is None:
+            key = installation_id or org
+            if not self._enter_installation(key):
+                self.seen_deliveries.delete(delivery_id)
+                DROPPED_EVENTS.inc(reason="installation_busy")
+                # One installation cannot take every thread; GitHub can redeliver the event
+                return "Too many events of this installation in progress.", 503
+            try:
+                process(*args)
+            finally:
+                self._exit_installation(key)
+        elif self.worker_pool.submit(
+            process,
+            *args,
+            # Events are queued per installation and served fairly
+            key=installation_id or org,
+            on_drop=lambda: self.seen_deliveries.delete(delivery_id),
+        ):
+            reason, http_code = "Accepted.", 202
+        else:
+            self.seen_deliveries.delete(delivery_id)
+            DROPPED_EVENTS.inc(reason="queue_full")
+            # GitHub will show the delivery as failed and it can be redelivered
+            reason, http_code = "Too many events queued.", 503
+        return reason, http_code
+
+    def _enter_installation(self, key) -> bool:
+        with self._installation_lock:
+            inflight = self._installation_inflight.get(key, 0)
+            if self.installation_max_concurrency and (
+                inflight >= self.installation_max_concurrency
+            ):
+                return False
+            self._installation_inflight[key] = inflight + 1
+            return True
+
+    def _exit_installation(self, key) -> None:
+        with self._installation_lock:
+            # Only installations with events in progress are kept
+            if self._installation_inflight[key] == 1:
+                del self._installation_inflight[key]
+            else:
+                self._installation_inflight[key] -= 1
+
+    def admit_event(self, data, headers):
+        """The response to a delivery and, if it needs processing, the arguments to process it.
+
+        It makes no network calls, thus, it is shared with the async path (see asgi.py).
+        """
         # We return 200 to make webhook not turn red since everything got processed well
         http_code = 200
         reason = "OK"
 
-        if headers["X-GitHub-Event"] != "workflow_job":
+        if headers["X-GitHub-Event"] == "push":
+            # The DSN is cached, thus, changes to the .sentry repo need to be picked up right away
+            if data["repository"]["name"] == ".sentry":
+                invalidate_dsn_cache(data["repository"]["owner"]["login"])
+                reason = "Sentry config cache invalidated."
+            else:
+                reason = "Event not supported."
+        elif headers["X-GitHub-Event"] != self.trace_event:
             reason = "Event not supported."
         elif data["action"] != "completed":
             reason = "We cannot do anything with this workflow state."
+        # For now, this simplifies testing
+        elif not self.dry_run:
+            # Repository webhooks (PAT mode) do not include the installation
+            installation_id = data.get("installation", {}).get("id")
+            org = data["repository"]["owner"]["login"]
+            event = data[self.trace_event]
+            # This happens before any token, API call or envelope is involved
+            if not self.keep_event(org, event):
+                return "Dropped by the org's sampling rules.", 200, None
+
+            delivery_id = headers.get("X-GitHub-Delivery")
+            if delivery_id and not self.seen_deliveries.add(delivery_id):
+                DROPPED_EVENTS.inc(reason="duplicate_delivery")
+                return "Delivery already processed.", 200, None
+
+            return reason, http_code, (installation_id, org, event, delivery_id)
+
+        return reason, http_code, None
+
+    def keep_event(self, org, event) -> bool:
+        """Whether the org's sampling and drop rules let the job (or run) through.
+
+        Only cached rules are used; when the org's config is not cached yet the event
+        is checked again once it has been fetched.
+        """
+        rules = get_cached_rules(org, self.config.workflow_run_mode)
+        if not rules:
+            return True
+        if self.config.workflow_run_mode:
+            keep = rules.keep(run_fields(event), f"run:{event['id']}")
         else:
-            # For now, this simplifies testing
-            if self.dry_run:
-                return reason, http_code
+            keep = rules.keep(job_fields(event), f"job:{event['id']}")
+        if not keep:
+            DROPPED_EVENTS.inc(reason="sampled")
+        return keep
 
-            installation_id = data["installation"]["id"]
-            org = data["repository"]["owner"]["login"]
+    def event_repo(self, event) -> str:
+        """The name of the job's (or run's) repository, e.g. sentry"""
+        if self.config.workflow_run_mode:
+            return run_fields(event)["repo"]
+        return job_fields(event)["repo"]
 
-            # We are executing in Github App mode
-            if self.config.gh_app:
-                with GithubAppToken(**self.config.gh_app._asdict()).get_token(
-                    installation_id
-                ) as token:
-                    # Once the Sentry org has a .sentry repo we can remove the DSN from the deployment
-                    dsn = fetch_dsn_for_github_org(org, token)
-                    client = GithubClient(
-                        token=token,
-                        dsn=dsn,
-                        dry_run=self.dry_run,
-                    )
-                    client.send_trace(data["workflow_job"])
-            else:
-                # Once the Sentry org has a .sentry repo we can remove the DSN from the deployment
-                dsn = fetch_dsn_for_github_org(org, token)
-                client = GithubClient(
-                    token=self.config.gh.token,
-                    dsn=dsn,
-                    dry_run=self.dry_run,
-                )
-                client.send_trace(data["workflow_job"])
+    def process_job(self, installation_id, org, job, delivery_id=None):
+        self._process(
+            installation_id,
+            org,
+            job,
+            delivery_id,
+            lambda client: client.send_trace(job),
+        )
 
-        return reason, http_code
+    def process_workflow_run(self, installation_id, org, run, delivery_id=None):
+        self._process(
+            installation_id,
+            org,
+            run,
+            delivery_id,
+            lambda client: client.send_workflow_run(run),
+        )
+
+    def _process(self, installation_id, org, event, delivery_id, send):
+        try:
+            with STAGE_DURATION.time(stage="job"):
+                try:
+                    self._send(installation_id, org, event, send)
+                except requests.HTTPError as e:
+                    if not self.invalidate_rejected_token(installation_id, e):
+                        raise
+                    # Once, with a new token
+                    self._send(installation_id, org, event, send)
+        except Exception:
+            # Allow redelivering the event
+            if delivery_id:
+                self.seen_deliveries.delete(delivery_id)
+            raise
+
+    def _send(self, installation_id, org, event, send):
+        client = self._get_client(installation_id, org, self.event_repo(event))
+        # The org's rules are cached now if they were not when the event arrived
+        if self.keep_event(org, event):
+            send(client)
+
+    def invalidate_rejected_token(self, installation_id, error) -> bool:
+        """Whether GitHub rejected the installation token, which is then forgotten.
+
+        Tokens are cached (and shared by processes) for most of their lifetime, thus, a
+        revoked token (e.g. the app was reinstalled) would otherwise keep being used.
+        """
+        resp = error.response
+        if (
+            self.gh_app_token is None
+            or resp is None
+            or resp.status_code != 401
+            or not resp.url.startswith(GITHUB_API_URL)
+        ):
+            return False
+        logger.warning(f"GitHub rejected the token of installation {installation_id}.")
+        self.gh_app_token.invalidate(installation_id)
+        return True
+
+    def _get_client(self, installation_id, org, repo=None) -> GithubClient:
+        token = self.get_token(installation_id)
+        # Once the Sentry org has a .sentry repo we can remove the DSN from the deployment
+        destinations = fetch_destinations_for_github_org(org, token, installation_id)
+        return self.make_client(token, destinations.for_repo(repo), installation_id)
+
+    def get_token(self, installation_id) -> str:
+        if not self.ready.wait(READY_TIMEOUT):
+            raise TimeoutError("The app is still warming up.")
+        # We are executing in Github App mode
+        if self.config.gh_app:
+            return self.gh_app_token.get_installation_token(installation_id)
+        return self.config.gh.token
+
+    def make_client(self, token, dsn, installation_id) -> GithubClient:
+        return GithubClient(
+            token=token,
+            dsn=dsn,
+            dry_run=self.dry_run,
+            enrichment_fields=self.config.enrichment_fields,
+            spool=self.spool,
+            installation_id=installation_id,
+            max_log_spans=self.config.max_log_spans,
+            sink=self.sink,
+        )
 
     def valid_signature(self, body, headers):
         if not self.config.gh.webhook_secret:
@@ -75,6 +343,36 @@ class WebAppHandler:
             return hmac.compare_digest(body_signature, signature)
 
 
+def peek_action(body: bytes) -> str | None:
+    """The payload's action without decoding it or None if it is not the first key"""
+    match = ACTION_RE.match(body)
+    return match.group(1).decode() if match else None
+
+
+def parse_event(body: bytes) -> dict:
+    """Decode a delivery keeping only the fields we use.
+
+    Payloads include the repository, sender and installation objects in full; dropping them
+    right away keeps queued events small.
+    """
+    payload = json.loads(body)
+    event = {}
+    if "action" in payload:
+        event["action"] = payload["action"]
+    if "installation" in payload:
+        event["installation"] = {"id": payload["installation"]["id"]}
+    if "repository" in payload:
+        repository = payload["repository"]
+        event["repository"] = {
+            "name": repository["name"],
+            "owner": {"login": repository["owner"]["login"]},
+        }
+    for key in ("workflow_job", "workflow_run"):
+        if key in payload:
+            event[key] = payload[key]
+    return event
+
+
 class GithubAppConfig(NamedTuple):
     app_id: int
     private_key: str
@@ -88,6 +386,9 @@ class GitHubConfig(NamedTuple):
 class Config(NamedTuple):
     gh_app: GithubAppConfig | None
     gh: GitHubConfig
+    enrichment_fields: frozenset[str] = ENRICHMENT_FIELDS
+    workflow_run_mode: bool = False
+    max_log_spans: int = 0
 
 
 def get_gh_app_private_key():
@@ -97,7 +398,8 @@ def get_gh_app_private_key():
         # XXX: Put in here since it currently affects test execution
         # ImportError: dlopen(/Users/armenzg/code/github-actions-app/.venv/lib/python3.10/site-packages/grpc/_cython/cygrpc.cpython-310-darwin.so, 0x0002): tried: '/Users/armenzg/code/github-actions-app/.venv/lib/python3.10/site-packages/grpc/_cython/cygrpc.cpython-310-darwin.so'
         # (mach-o file, but is an incompatible architecture (have 'x86_64', need 'arm64e'))
-        from google.cloud import secretmanager
+        with startup_profile.step("import google.cloud.secretmanager"):
+            from google.cloud import secretmanager
 
         gcp_client = secretmanager.SecretManagerServiceClient()
         uri = (
@@ -105,24 +407,36 @@ def get_gh_app_private_key():
         )
 
         logger.info(f"Grabbing secret from {uri}")
-        private_key = base64.b64decode(
-            gcp_client.access_secret_version(
-                name=uri,
-            ).payload.data.decode("UTF-8"),
-        )
+        with startup_profile.step("fetch private key"):
+            private_key = base64.b64decode(
+                gcp_client.access_secret_version(
+                    name=uri,
+                ).payload.data.decode("UTF-8"),
+            )
     else:
         # This block only applies for development since we are not executing on GCP
         private_key = base64.b64decode(os.environ["GH_APP_PRIVATE_KEY"])
     return private_key
 
 
-def init_config():
-    gh_app = None
+def get_enrichment_fields():
+    # e.g. "author,pull_request" or "" to only use the webhook payload
+    value = os.environ.get("GH_ENRICHMENT_FIELDS")
+    if value is None:
+        return ENRICHMENT_FIELDS
+    fields = frozenset(field.strip() for field in value.split(",") if field.strip())
+    unknown = fields - ENRICHMENT_FIELDS
+    if unknown:
+        logger.warning(f"Ignoring unknown enrichment fields: {sorted(unknown)}")
+    return fields & ENRICHMENT_FIELDS
+
+
+def load_gh_app_config() -> GithubAppConfig | None:
     try:
         # This variable is the key to enabling Github App mode or not
         if os.environ.get("GH_APP_ID"):
             private_key = get_gh_app_private_key()
-            gh_app = GithubAppConfig(
+            return GithubAppConfig(
                 app_id=os.environ["GH_APP_ID"],
                 private_key=private_key,
             )
@@ -131,12 +445,22 @@ def init_config():
         logger.warning(
             "We have failed to load the private key, however, we will fallback to the PAT method.",
         )
+    return None
+
 
+def init_config(load_gh_app: bool = True):
     return Config(
-        gh_app,
+        # Otherwise, it is loaded later with load_gh_app_config()
+        load_gh_app_config() if load_gh_app else None,
         GitHubConfig(
             # This token is a PAT
             token=os.environ.get("GH_TOKEN"),
             webhook_secret=os.environ.get("GH_WEBHOOK_SECRET"),
         ),
+        get_enrichment_fields(),
+        # Ingest all jobs of a run from workflow_run events rather than one workflow_job at a time
+        workflow_run_mode=os.environ.get("WORKFLOW_RUN_MODE", "").lower()
+        in ("1", "true"),
+        # Opt-in since it downloads each job's log
+        max_log_spans=int(os.environ.get("GH_LOG_SPANS_MAX", 0)),
     )
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+from sentry_sdk import capture_exception
+
+from .metrics import DROPPED_EVENTS
+
+logger = logging.getLogger(__name__)
+
+# What to do with an event when its installation's queue (or the whole queue) is full
+OVERFLOW_REJECT = "reject"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+# Returned when no key can be served; None is a valid key
+_NONE_ELIGIBLE = object()
+
+
+def parse_weights(value: str) -> dict[Hashable, float]:
+    """Parse weights such as "12345:4,67890:0.5" keyed by installation ID (or org for PATs)"""
+    weights: dict[Hashable, float] = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        key, weight = pair.rsplit(":", 1)
+        key = key.strip()
+        weights[int(key) if key.isdigit() else key] = float(weight)
+    return weights
+
+
+class FairQueue:
+    """A FIFO queue per key (installation) served with weighted fair queueing.
+
+    Keys take turns using stride scheduling: each time a key is served its pass
+    advances by 1 / weight and the key with work and the lowest pass goes next.
+    A key with weight 2 is served twice as often as one with weight 1 while both
+    have events queued, and a key that shows up is served right away rather than
+    after the backlog of the others.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        weights: dict[Hashable, float] | None = None,
+        max_concurrency: int = 0,
+        key_maxsize: int = 0,
+        overflow: str = OVERFLOW_REJECT,
+        on_drop: Callable[[Any], None] | None = None,
+    ) -> None:
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unknown overflow behaviour: {overflow}")
+        self.maxsize = maxsize
+        self.weights = weights or {}
+        # Items of a key being processed at once; 0 means no limit
+        self.max_concurrency = max_concurrency
+        # Items of a key waiting at once; 0 means only maxsize applies
+        self.key_maxsize = key_maxsize
+        self.overflow = overflow
+        # Called with each item dropped to make room
+        self.on_drop = on_drop
+        self._queues: dict[Hashable, deque] = {}
+        # Only keys with queued or running items have a pass
+        self._passes: dict[Hashable, float] = {}
+        self._running: dict[Hashable, int] = {}
+        # Pass of the last key served; keys showing up start from it
+        self._virtual_time = 0.0
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def put(self, key: Hashable, item: Any) -> bool:
+        """Queue the item without blocking; False means it was rejected"""
+        with self._cond:
+            if self._closed:
+                return False
+            items = self._queues.get(key)
+            if self.key_maxsize and items and len(items) >= self.key_maxsize:
+                if not self._drop_oldest(key):
+                    return False
+            # Like queue.Queue, a maxsize of 0 means it is unbounded
+            if 0 < self.maxsize <= self._size:
+                # The installation with the largest backlog gives up its oldest event
+                victim = max(
+                    self._queues, key=lambda k: len(self._queues[k]), default=None
+                )
+                if victim is None or not self._drop_oldest(victim):
+                    return False
+            if key not in self._queues:
+                self._queues[key] = deque()
+                self._passes.setdefault(key, self._virtual_time)
+            self._queues[key].append(item)
+            self._size += 1
+            self._cond.notify()
+            return True
+
+    def get(self) -> tuple[Hashable, Any] | None:
+        """Block until an item can be processed; None once closed and empty"""
+        with self._cond:
+            while True:
+                key = self._next_key()
+                if key is not _NONE_ELIGIBLE:
+                    break
+                if self._closed and not self._size:
+                    return None
+                self._cond.wait()
+            items = self._queues[key]
+            item = items.popleft()
+            if not items:
+                del self._queues[key]
+            self._size -= 1
+            self._running[key] = self._running.get(key, 0) + 1
+            self._virtual_time = self._passes[key]
+            self._passes[key] += 1 / self.weights.get(key, 1)
+            return key, item
+
+    def task_done(self, key: Hashable) -> None:
+        with self._cond:
+            self._running[key] -= 1
+            if not self._running[key]:
+                del self._running[key]
+                if key not in self._queues:
+                    del self._passes[key]
+            # A key under its concurrency limit may be eligible again
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """Reject new items; get() returns None once the queued ones are taken"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _next_key(self) -> Hashable:
+        eligible = [
+            key
+            for key in self._queues
+            if not self.max_concurrency
+            or self._running.get(key, 0) < self.max_concurrency
+        ]
+        return min(eligible, key=self._passes.__getitem__, default=_NONE_ELIGIBLE)
+
+    def _drop_oldest(self, key: Hashable) -> bool:
+        if self.overflow != OVERFLOW_DROP_OLDEST:
+            return False
+        items = self._queues[key]
+        item = items.popleft()
+        if not items:
+            del self._queues[key]
+            if key not in self._running:
+                del self._passes[key]
+        self._size -= 1
+        DROPPED_EVENTS.inc(reason="queue_overflow")
+        logger.warning(f"Dropped the oldest queued event of {key}.")
+        if self.on_drop:
+            self.on_drop(item)
+        return True
+
+
+class WorkerPool:
+    """Bounded pool of threads processing webhook events outside of the request.
+
+    `submit` never blocks; it returns False when the queue is full so the caller
+    can push back (e.g. with a 503) rather than piling up work. Events are keyed
+    by installation and served fairly (see FairQueue), thus, one org completing
+    hundreds of jobs does not hold up the others.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        queue_size: int,
+        weights: dict[Hashable, float] | None = None,
+        max_concurrency: int = 0,
+        key_queue_size: int = 0,
+        overflow: str = OVERFLOW_REJECT,
+    ) -> None:
+        self.size = size
+        self._queue = FairQueue(
+            queue_size,
+            weights=weights,
+            max_concurrency=max_concurrency,
+            key_maxsize=key_queue_size,
+            overflow=overflow,
+            on_drop=self._dropped,
+        )
+        self._accepting = True
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            for i in range(size)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def submit(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        key: Hashable = None,
+        on_drop: Callable[[], None] | None = None,
+    ) -> bool:
+        """Queue func(*args) under the key (e.g. the installation).
+
+        on_drop is called if the event is later dropped to make room for others.
+        """
+        with self._lock:
+            if not self._accepting:
+                return False
+            return self._queue.put(key, (func, args, on_drop))
+
+    def shutdown(self, timeout: float | None = None) -> None:
+        """Stop accepting work and wait for the queued events to be processed"""
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+        logger.info(f"Draining {self.qsize()} queued events.")
+        self._queue.close()
+        # The timeout applies to the whole drain rather than to each thread
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(
+                None if deadline is None else max(deadline - time.monotonic(), 0)
+            )
+
+    def _dropped(self, item: tuple) -> None:
+        on_drop = item[2]
+        if on_drop:
+            on_drop()
+
+    def _work(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            key, (func, args, _) = entry
+            try:
+                func(*args)
+            except Exception as e:
+                # The webhook has already been acknowledged, thus, this is the only place to report it
+                logger.exception(e)
+                capture_exception(e)
+            finally:
+                self._queue.task_done(key)
@@ -4,6 +4,21 @@ import json
 
 import pytest
 
+from src.github_sdk import clear_metadata_cache
+from src.http_client import http_client
+from src.rate_limit import rate_limiter
+from src.sentry_config import invalidate_dsn_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # Caches are module level, thus, they would leak between tests
+    invalidate_dsn_cache()
+    clear_metadata_cache()
+    http_client.reset()
+    rate_limiter.reset()
+    yield
+
 
 @pytest.fixture
 def jobA_job():
@@ -53,3 +68,16 @@ def uuid_list():
 def webhook_event():
     with open("tests/fixtures/webhook_event.json") as f:
         return json.load(f)
+
+
+@pytest.fixture(scope="session")
+def private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
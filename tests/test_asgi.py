@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from unittest import mock
+
+import pytest
+
+from src.asgi import ASGIApp
+from src.asgi import AsyncWebAppHandler
+from src.sentry_config import _dsn_cache
+from src.sentry_config import CachedDsn
+from src.sentry_config import Destinations
+from src.web_app_handler import WebAppHandler
+
+DSN = "https://foo@sentry.example.com/1"
+DESTINATIONS = Destinations(DSN)
+
+
+@pytest.fixture
+def async_handler(monkeypatch):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    monkeypatch.delenv("GH_WEBHOOK_SECRET", raising=False)
+    return AsyncWebAppHandler(WebAppHandler())
+
+
+async def request(app, method, path, body=b"", headers=None):
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [
+            (key.lower().encode(), str(value).encode())
+            for key, value in (headers or {}).items()
+        ],
+    }
+    await app(scope, receive, send)
+    return sent[0]["status"], sent[1]["body"]
+
+
+def post(app, webhook_event, payload=None):
+    body = json.dumps(payload or webhook_event["payload"]).encode()
+    return request(app, "POST", "/", body, webhook_event["headers"])
+
+
+def test_ignored_delivery(async_handler):
+    app = ASGIApp(async_handler)
+    status, body = asyncio.run(
+        request(app, "POST", "/", b"{}", {"X-GitHub-Event": "check_run"})
+    )
+    assert status == 200
+    assert json.loads(body) == {"reason": "Event not supported."}
+
+
+def test_invalid_signature(monkeypatch, webhook_event):
+    monkeypatch.setenv("GH_WEBHOOK_SECRET", "mistyped_secret")
+    app = ASGIApp(AsyncWebAppHandler(WebAppHandler()))
+    status, _ = asyncio.run(post(app, webhook_event))
+    assert status == 400
+
+
+@mock.patch("src.asgi.fetch_destinations_for_github_org", return_value=DESTINATIONS)
+def test_job_is_processed_before_responding(_, async_handler, webhook_event):
+    app = ASGIApp(async_handler)
+
+    async def deliver():
+        with mock.patch.object(async_handler.handler, "make_client") as make_client:
+            status, body = await post(app, webhook_event)
+            make_client.return_value.send_trace.assert_called_once()
+            responses = [(status, body), await post(app, webhook_event)]
+        return responses, make_client
+
+    responses, make_client = asyncio.run(deliver())
+    assert responses[0] == (200, b'{"reason": "OK"}')
+    assert responses[1] == (200, b'{"reason": "Delivery already processed."}')
+    job = webhook_event["payload"]["workflow_job"]
+    make_client.return_value.send_trace.assert_called_once_with(job)
+    assert async_handler.inflight == 0
+
+
+def test_dsn_and_run_are_fetched_concurrently(async_handler, webhook_event):
+    # The org's rules are known, thus, the run can be fetched along with the DSN
+    _dsn_cache.set("armenzg", CachedDsn(DSN, None, ""))
+    both_started = threading.Barrier(2, timeout=5)
+
+    def fetch_destinations(*args):
+        both_started.wait()
+        return DESTINATIONS
+
+    async def process():
+        with mock.patch(
+            "src.asgi.fetch_destinations_for_github_org", side_effect=fetch_destinations
+        ), mock.patch.object(async_handler.handler, "make_client") as make_client:
+            make_client.return_value.prefetch_run.side_effect = (
+                lambda job: both_started.wait()
+            )
+            await async_handler.process_job(
+                1, "armenzg", webhook_event["payload"]["workflow_job"]
+            )
+        return make_client
+
+    make_client = asyncio.run(process())
+    make_client.return_value.send_trace.assert_called_once()
+
+
+@mock.patch("src.asgi.fetch_destinations_for_github_org", side_effect=ValueError)
+def test_failed_event_can_be_redelivered(_, async_handler, webhook_event):
+    app = ASGIApp(async_handler)
+
+    with mock.patch("src.asgi.capture_exception") as capture_exception:
+        status, _ = asyncio.run(post(app, webhook_event))
+    assert status == 500
+    capture_exception.assert_called_once()
+    delivery_id = webhook_event["headers"]["X-GitHub-Delivery"]
+    assert async_handler.handler.seen_deliveries.get(delivery_id) is None
+
+
+def test_too_many_events_in_flight(async_handler, webhook_event):
+    async_handler.max_inflight = 0
+    status, body = asyncio.run(post(ASGIApp(async_handler), webhook_event))
+    assert (status, json.loads(body)) == (503, {"reason": "Too many events queued."})
+
+
+def test_ready_and_metrics(async_handler):
+    app = ASGIApp(async_handler)
+    assert asyncio.run(request(app, "GET", "/ready"))[0] == 200
+    async_handler.handler.ready.clear()
+    assert asyncio.run(request(app, "GET", "/ready"))[0] == 503
+    status, body = asyncio.run(request(app, "GET", "/metrics"))
+    assert status == 200
+    assert b"gha_stage_duration_seconds" in body
+
+
+def test_lifespan_closes_the_handler(async_handler):
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    with mock.patch.object(async_handler, "close") as close:
+        asyncio.run(ASGIApp(async_handler)({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    close.assert_called_once()
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from src.cache import make_cache
+from src.cache import SQLiteCache
+from src.cache import TTLCache
+
+
+def test_entries_expire():
+    cache = TTLCache(ttl=0)
+    cache.set("foo", 1)
+    assert cache.get("foo") is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+
+def test_get_or_set_coalesces_concurrent_calls():
+    cache = TTLCache()
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return "value"
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_set("key", slow_fetch))
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_get_or_set_does_not_cache_errors():
+    cache = TTLCache()
+
+    def failing_fetch():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        cache.get_or_set("key", failing_fetch)
+    assert cache.get_or_set("key", lambda: "value") == "value"
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / "cache.db")
+    # Each instance has its own connection like separate processes would
+    first = SQLiteCache(path, "runs")
+    second = SQLiteCache(path, "runs")
+    first.set((1, 1), {"id": 1})
+    assert second.get((1, 1)) == {"id": 1}
+    # Namespaces do not collide
+    assert SQLiteCache(path, "workflows").get((1, 1)) is None
+    assert second.add("a") is True
+    assert first.add("a") is False
+    first.delete("a")
+    assert second.get("a") is None
+    second.clear()
+    assert len(first) == 0
+
+
+def test_sqlite_cache_entries_expire(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.db"), "runs", ttl=0)
+    cache.set("foo", 1)
+    assert cache.get("foo") is None
+    assert cache.add("foo") is True
+
+
+def test_sqlite_cache_coalesces_misses_across_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.cache.LEASE_POLL_INTERVAL", 0.01)
+    path = str(tmp_path / "cache.db")
+    caches = [SQLiteCache(path, "dsn") for _ in range(3)]
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return "value"
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda cache=cache: results.append(
+                cache.get_or_set("key", slow_fetch)
+            )
+        )
+        for cache in caches
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value"] * 3
+    assert len(calls) == 1
+
+
+def test_sqlite_cache_keeps_the_lease_of_another_process(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.cache.LEASE_POLL_INTERVAL", 0.01)
+    path = str(tmp_path / "cache.db")
+    holder, waiter = SQLiteCache(path, "dsn"), SQLiteCache(path, "dsn")
+    assert holder._acquire_lease("key")
+    # The waiter gives up waiting and computes the value without taking the lease
+    monkeypatch.setattr("src.cache.LEASE_TIMEOUT", 0.05)
+    assert waiter._compute("key", lambda: "value") == "value"
+    assert not waiter._acquire_lease("key")
+
+
+def test_make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.cache.CACHE_PATH", None)
+    assert isinstance(make_cache("runs"), TTLCache)
+    monkeypatch.setattr("src.cache.CACHE_PATH", str(tmp_path / "cache.db"))
+    assert isinstance(make_cache("runs"), SQLiteCache)
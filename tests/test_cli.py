@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import gzip
+import json
+from datetime import date
+from unittest import mock
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import responses
+from sentry_sdk.envelope import Envelope
+
+from cli import Backfill
+from cli import Checkpoint
+from cli import Replay
+from src.file_sink import FileSink
+
+RUNS_URL = "https://api.github.com/repos/getsentry/sentry/actions/runs"
+SENTRY_URL = "https://foo@bar.ingest.sentry.io/api/1/envelope/"
+
+
+@responses.activate
+@mock.patch("cli.fetch_destinations_for_github_org")
+@mock.patch("cli.GithubClient")
+def test_backfill_resumes_from_checkpoint(
+    mock_client, mock_fetch_destinations, tmp_path, jobA_job, jobA_runs
+):
+    app_token = mock.Mock()
+    app_token.get_installation_token.return_value = "token"
+    second_run = {**jobA_runs, "id": 1}
+    responses.get(
+        RUNS_URL, json={"total_count": 2, "workflow_runs": [jobA_runs, second_run]}
+    )
+    responses.get(
+        f"{RUNS_URL}/2104746951/attempts/1/jobs",
+        json={"jobs": [jobA_job, jobA_job]},
+    )
+    responses.get(f"{RUNS_URL}/1/attempts/1/jobs", json={"jobs": [jobA_job]})
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.jsonl"))
+    # The second run was backfilled by a previous invocation
+    checkpoint.add(second_run)
+    backfill = Backfill(app_token, 123, "getsentry/sentry")
+    assert backfill.run(days=1, concurrency=2, checkpoint=checkpoint) == 0
+
+    assert mock_client.return_value.send_trace.call_count == 2
+    mock_fetch_destinations.return_value.for_repo.assert_called_once_with("sentry")
+    assert Checkpoint(checkpoint.path).done == {"1:1", "2104746951:1"}
+
+
+def test_checkpoint_ignores_an_incomplete_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text('{"run": "1:1"}\n{"run": "2:')
+    assert Checkpoint(str(path)).done == {"1:1"}
+
+
+@responses.activate
+def test_backfill_splits_days_with_too_many_runs():
+    day = date.today().isoformat()
+
+    def list_runs(request):
+        created = parse_qs(urlsplit(request.url).query)["created"][0]
+        if created == f"{day}T00:00:00Z..{day}T23:59:59Z":
+            # The search would only return 1,000 of them
+            return 200, {}, json.dumps({"total_count": 1500, "workflow_runs": []})
+        runs = [{"id": created}]
+        return 200, {}, json.dumps({"total_count": 1, "workflow_runs": runs})
+
+    responses.add_callback(responses.GET, RUNS_URL, callback=list_runs)
+    app_token = mock.Mock()
+    app_token.get_installation_token.return_value = "token"
+    runs = list(Backfill(app_token, 123, "getsentry/sentry").runs(days=1))
+    assert [run["id"] for run in runs] == [
+        f"{day}T00:00:00Z..{day}T11:59:59Z",
+        f"{day}T12:00:00Z..{day}T23:59:59Z",
+    ]
+
+
+@responses.activate
+def test_replay(tmp_path, jobA_trace):
+    sink = FileSink(str(tmp_path))
+    for i in range(5):
+        sink.write({**jobA_trace, "event_id": str(i)})
+    sink.close()
+    responses.post(SENTRY_URL, status=429, headers={"Retry-After": "0"})
+    responses.post(SENTRY_URL)
+
+    replay = Replay("https://foo@bar.ingest.sentry.io/1", concurrency=2, batch_size=2)
+    assert replay.run([str(tmp_path)]) == 0
+    # The first attempt was rate limited
+    assert len(responses.calls) == 6
+    event_ids = {
+        Envelope.deserialize(
+            gzip.decompress(call.request.body)
+        ).get_transaction_event()["event_id"]
+        for call in responses.calls
+    }
+    assert event_ids == {"0", "1", "2", "3", "4"}
+
+
+@responses.activate
+def test_replay_failures(tmp_path, jobA_trace):
+    sink = FileSink(str(tmp_path))
+    sink.write(jobA_trace)
+    sink.close()
+    responses.post(SENTRY_URL, status=400)
+    assert Replay("https://foo@bar.ingest.sentry.io/1").run([str(tmp_path)]) == 1
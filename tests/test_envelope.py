@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import gzip
+import io
+
+import pytest
+from sentry_sdk.envelope import Envelope
+
+from src.envelope import EnvelopeEncoder
+from src.envelope import get_encoder
+
+DSN = "https://foo@random.ingest.sentry.io/bar"
+
+
+def serialize_with_sdk(trace):
+    envelope = Envelope()
+    envelope.add_transaction(trace)
+    body = io.BytesIO()
+    envelope.serialize_into(body)
+    return body.getvalue()
+
+
+def test_same_envelope_as_sentry_sdk(jobA_trace):
+    headers, body = EnvelopeEncoder(DSN).encode(jobA_trace)
+    envelope = Envelope.deserialize(gzip.decompress(body))
+    expected = Envelope.deserialize(serialize_with_sdk(jobA_trace))
+    assert envelope.headers == expected.headers
+    assert [item.headers for item in envelope.items] == [
+        item.headers for item in expected.items
+    ]
+    assert envelope.get_transaction_event() == jobA_trace
+    assert headers["event_id"] == jobA_trace["event_id"]
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["X-Sentry-Auth"].startswith(
+        "Sentry sentry_key=foo,sentry_client=gha-sentry/0.0.1,sentry_timestamp="
+    )
+
+
+def test_uncompressed(jobA_trace):
+    encoder = EnvelopeEncoder("http://foo@localhost:3000/1", compression_level=0)
+    headers, body = encoder.encode(jobA_trace)
+    assert "Content-Encoding" not in headers
+    assert Envelope.deserialize(body).get_transaction_event() == jobA_trace
+    assert encoder.url == "http://foo@localhost:3000/api/1/envelope/"
+
+
+def test_invalid_compression_level():
+    with pytest.raises(ValueError):
+        EnvelopeEncoder(DSN, compression_level=10)
+
+
+def test_encoder_per_dsn():
+    assert get_encoder(DSN) is get_encoder(DSN)
+    assert get_encoder(DSN) is not get_encoder("https://bar@random.ingest.sentry.io/1")
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import os
+
+from src.file_sink import create_sink
+from src.file_sink import FileSink
+from src.file_sink import OPEN_SUFFIX
+from src.file_sink import read_segments
+from src.file_sink import SEGMENT_SUFFIX
+
+
+def test_segments_rotate_by_size(tmp_path):
+    sink = FileSink(str(tmp_path), max_bytes=80)
+    transactions = [{"event_id": str(i), "padding": "x" * 10} for i in range(5)]
+    for transaction in transactions:
+        sink.write(transaction)
+    # The last segment is still open, thus, it is not replayed yet
+    assert list(read_segments([str(tmp_path)])) == transactions[:4]
+    sink.close()
+    assert list(read_segments([str(tmp_path)])) == transactions
+    names = os.listdir(tmp_path)
+    assert len(names) == 3
+    assert all(name.endswith(SEGMENT_SUFFIX) for name in names)
+
+
+def test_segments_rotate_by_age(tmp_path):
+    sink = FileSink(str(tmp_path), max_age=0)
+    sink.write({"event_id": "1"})
+    sink.write({"event_id": "2"})
+    names = os.listdir(tmp_path)
+    assert sorted(name.endswith(OPEN_SUFFIX) for name in names) == [False, True]
+
+
+def test_read_given_segments(tmp_path):
+    sink = FileSink(str(tmp_path))
+    sink.write({"event_id": "1"})
+    sink.close()
+    (path,) = tmp_path.iterdir()
+    assert list(read_segments([str(path), str(path)])) == [{"event_id": "1"}] * 2
+
+
+def test_create_sink(monkeypatch, tmp_path):
+    monkeypatch.delenv("SINK_PATH", raising=False)
+    assert create_sink() is None
+    monkeypatch.setenv("SINK_PATH", str(tmp_path / "segments"))
+    monkeypatch.setenv("SINK_SEGMENT_BYTES", "1024")
+    sink = create_sink()
+    assert sink.max_bytes == 1024
+    assert os.path.isdir(tmp_path / "segments")
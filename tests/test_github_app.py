@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import responses
+from freezegun import freeze_time
+
+from src.github_app import GithubAppToken
+
+INSTALLATION_ID = 123
+TOKEN_URL = f"https://api.github.com/app/installations/{INSTALLATION_ID}/access_tokens"
+
+
+def _mock_token(token, expires_at="2022-05-01T13:00:00Z"):
+    responses.post(TOKEN_URL, json={"token": token, "expires_at": expires_at})
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+@responses.activate
+def test_token_is_reused(private_key):
+    _mock_token("first")
+    app_token = GithubAppToken(private_key, app_id=1)
+    with app_token.get_token(INSTALLATION_ID) as token:
+        assert token == "first"
+    with app_token.get_token(INSTALLATION_ID) as token:
+        assert token == "first"
+    # Only one token was minted and it was never revoked
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_token_is_refreshed_before_expiring(private_key):
+    _mock_token("first")
+    app_token = GithubAppToken(private_key, app_id=1)
+    with freeze_time("2022-05-01T12:00:00Z"):
+        assert app_token.get_installation_token(INSTALLATION_ID) == "first"
+
+    _mock_token("second", expires_at="2022-05-01T14:00:00Z")
+    # We are within the refresh margin of the first token
+    with freeze_time("2022-05-01T12:56:00Z"):
+        assert app_token.get_installation_token(INSTALLATION_ID) == "second"
+    assert len(responses.calls) == 2
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+@responses.activate
+def test_invalidate_token(private_key):
+    _mock_token("first")
+    app_token = GithubAppToken(private_key, app_id=1)
+    app_token.get_installation_token(INSTALLATION_ID)
+    app_token.invalidate(INSTALLATION_ID)
+    app_token.get_installation_token(INSTALLATION_ID)
+    assert len(responses.calls) == 2
+
+
+def test_jwt_is_reused(private_key):
+    app_token = GithubAppToken(private_key, app_id=1)
+    with freeze_time("2022-05-01T12:00:00Z"):
+        jwt_token = app_token.get_jwt_token()
+    # Still within the JWT's lifetime
+    with freeze_time("2022-05-01T12:03:00Z"):
+        assert app_token.get_jwt_token() == jwt_token
+    # Close to the 5 minutes expiration
+    with freeze_time("2022-05-01T12:04:30Z"):
+        assert app_token.get_jwt_token() != jwt_token
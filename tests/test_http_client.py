@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import pytest
+import responses
+
+from src.http_client import CircuitBreaker
+from src.http_client import CircuitOpenError
+from src.http_client import HttpClient
+
+URL = "https://api.github.com/repos/getsentry/sentry"
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    # The reset timeout has passed, thus, one request is let through
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.opened_at is None
+
+
+@responses.activate
+def test_host_failing_opens_the_circuit(monkeypatch):
+    monkeypatch.setattr("src.http_client.CIRCUIT_FAILURE_THRESHOLD", 2)
+    responses.get(URL, status=502)
+    client = HttpClient()
+    client.get(URL)
+    client.get(URL)
+    with pytest.raises(CircuitOpenError):
+        client.get(URL)
+    assert len(responses.calls) == 2
+    # Other hosts are not affected
+    responses.get("https://random.ingest.sentry.io/")
+    assert client.get("https://random.ingest.sentry.io/").status_code == 200
+
+
+@responses.activate
+def test_requests_have_a_timeout():
+    responses.get(URL)
+    client = HttpClient(timeout=(1, 2))
+    client.get(URL)
+    assert responses.calls[0].request.req_kwargs["timeout"] == (1, 2)
+
+
+@responses.activate
+def test_warm_opens_connections_ahead_of_time():
+    responses.head(URL)
+    HttpClient().warm(URL, connections=2)
+    assert [call.request.method for call in responses.calls] == ["HEAD", "HEAD"]
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from src.job_logs import generate_log_spans
+from src.job_logs import LogGroup
+from src.job_logs import parse_log_groups
+
+LOG = b"""\xef\xbb\xbf2022-04-06T19:52:16.5000000Z ##[group]Operating System
+2022-04-06T19:52:16.6000000Z Ubuntu
+2022-04-06T19:52:16.7000000Z ##[endgroup]
+2022-04-06T19:53:00.1000000Z ##[group]Run yarn test
+2022-04-06T19:53:00.1100000Z yarn test
+2022-04-06T19:53:00.1200000Z ##[endgroup]
+2022-04-06T19:53:01.0000000Z ##[group]Install dependencies
+2022-04-06T19:53:40.0000000Z ##[endgroup]
+2022-04-06T19:53:41.0000000Z ##[group]Run tests
+2022-04-06T20:05:00.0000000Z ##[endgroup]
+"""
+
+STEP_SPANS = [
+    {
+        "name": "Set up job",
+        "span_id": "a" * 16,
+        "start_timestamp": "2022-04-06T19:52:16.000Z",
+        "timestamp": "2022-04-06T19:52:20.000Z",
+        "trace_id": "t" * 32,
+    },
+    {
+        "name": "Run yarn test",
+        "span_id": "b" * 16,
+        "start_timestamp": "2022-04-06T19:53:00.000Z",
+        "timestamp": "2022-04-06T20:05:30.000Z",
+        "trace_id": "t" * 32,
+    },
+]
+
+
+def test_parse_log_groups():
+    groups = list(parse_log_groups(LOG.splitlines()))
+    assert groups[0] == LogGroup(
+        "Operating System",
+        "2022-04-06T19:52:16.5000000Z",
+        "2022-04-06T19:52:16.7000000Z",
+    )
+    assert [group.name for group in groups] == [
+        "Operating System",
+        "Run yarn test",
+        "Install dependencies",
+        "Run tests",
+    ]
+
+
+def test_generate_log_spans():
+    spans = generate_log_spans(parse_log_groups(LOG.splitlines()), STEP_SPANS, 10)
+    # The group showing the step's command is not a span
+    assert [(span["name"], span["parent_span_id"]) for span in spans] == [
+        ("Operating System", "a" * 16),
+        ("Install dependencies", "b" * 16),
+        ("Run tests", "b" * 16),
+    ]
+    assert spans[1]["start_timestamp"] == "2022-04-06T19:53:01.0000000Z"
+    assert spans[1]["timestamp"] == "2022-04-06T19:53:40.0000000Z"
+
+
+def test_generate_log_spans_stops_reading_at_the_cap():
+    lines = iter(LOG.splitlines())
+    spans = generate_log_spans(parse_log_groups(lines), STEP_SPANS, 1)
+    assert len(spans) == 1
+    # The rest of the log was not read
+    assert next(lines).endswith(b"##[group]Run yarn test")
+
+
+def test_steps_which_did_not_run_are_skipped():
+    cancelled = {
+        **STEP_SPANS[0],
+        "name": "Upload coverage",
+        "span_id": "c" * 16,
+        "start_timestamp": None,
+        "timestamp": None,
+    }
+    spans = generate_log_spans(
+        parse_log_groups(LOG.splitlines()), [cancelled, *STEP_SPANS], 10
+    )
+    assert [span["name"] for span in spans] == [
+        "Operating System",
+        "Install dependencies",
+        "Run tests",
+    ]
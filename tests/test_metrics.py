@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from src.metrics import Counter
+from src.metrics import Gauge
+from src.metrics import Histogram
+from src.metrics import Registry
+
+
+def test_counter():
+    counter = Counter("requests_total", "Requests.", ["cache", "result"])
+    counter.inc(cache="dsn", result="hit")
+    counter.inc(2, cache="dsn", result="hit")
+    assert counter.value(cache="dsn", result="hit") == 3
+    assert counter.render() == "\n".join(
+        [
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{cache="dsn",result="hit"} 3',
+        ]
+    )
+
+
+def test_gauge():
+    gauge = Gauge("queue_depth", "Depth.", ["queue"])
+    gauge.set_function(lambda: {("worker",): 4})
+    assert gauge.samples() == ['queue_depth{queue="worker"} 4']
+
+
+def test_histogram():
+    histogram = Histogram("duration_seconds", "Duration.", ["stage"], buckets=(1, 5))
+    histogram.observe(0.5, stage="job")
+    histogram.observe(3, stage="job")
+    histogram.observe(10, stage="job")
+    assert histogram.count(stage="job") == 3
+    assert histogram.samples() == [
+        'duration_seconds_bucket{stage="job",le="1"} 1',
+        'duration_seconds_bucket{stage="job",le="5"} 2',
+        'duration_seconds_bucket{stage="job",le="+Inf"} 3',
+        'duration_seconds_sum{stage="job"} 13.5',
+        'duration_seconds_count{stage="job"} 3',
+    ]
+
+
+def test_registry_render():
+    registry = Registry()
+    registry.register(Counter("foo_total", "Foo.")).inc()
+    assert (
+        registry.render()
+        == "# HELP foo_total Foo.\n# TYPE foo_total counter\nfoo_total 1\n"
+    )
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import pytest
+import requests
+import responses
+from freezegun import freeze_time
+
+from src.github_sdk import GithubClient
+from src.rate_limit import RateLimiter
+from src.rate_limit import RateLimitExceeded
+
+NOW = 1651406400  # 2022-05-01T12:00:00Z
+
+
+def _response(status=200, **headers):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers)
+    return resp
+
+
+def _rate_limit(remaining, limit=5000, reset=NOW + 3600):
+    return {
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset": str(reset),
+    }
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_unknown_installations_are_not_limited():
+    limiter = RateLimiter()
+    limiter.acquire(1)
+    assert limiter.is_low(1) is False
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_budget_is_tracked():
+    limiter = RateLimiter()
+    limiter.update(1, _response(**_rate_limit(100)))
+    limiter.acquire(1)
+    assert limiter.remaining() == {1: 99}
+    assert limiter.is_low(1)
+    limiter.update(1, _response(**_rate_limit(4000)))
+    assert limiter.is_low(1) is False
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_calls_go_through_while_budget_is_left():
+    limiter = RateLimiter()
+    limiter.update(1, _response(**_rate_limit(4900, reset=NOW + 50 * 60)))
+    # e.g. a burst of completed jobs
+    for _ in range(200):
+        limiter.acquire(1, max_wait=0)
+    assert limiter.remaining() == {1: 4700}
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_calls_are_paced_when_budget_is_low():
+    limiter = RateLimiter()
+    limiter.update(1, _response(**_rate_limit(101)))
+    limiter.acquire(1, max_wait=0)
+    # The 100 calls left are spread over the hour until the reset
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(1, max_wait=30)
+    with freeze_time("2022-05-01T12:00:36Z"):
+        limiter.acquire(1, max_wait=0)
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_exhausted_budget():
+    limiter = RateLimiter()
+    limiter.update(1, _response(**_rate_limit(0)))
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(1, max_wait=1)
+    # Other installations have their own budget
+    limiter.acquire(2)
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_secondary_rate_limit():
+    limiter = RateLimiter()
+    limiter.update(1, _response(403, **_rate_limit(4000), **{"Retry-After": "60"}))
+    assert limiter.is_low(1)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(1, max_wait=1)
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+def test_secondary_rate_limit_without_retry_after():
+    limiter = RateLimiter()
+    resp = _response(403)
+    resp._content = b'{"message": "You have exceeded a secondary rate limit."}'
+    # The installation's budget was not known yet
+    limiter.update(1, resp)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(1, max_wait=59)
+    with freeze_time("2022-05-01T12:01:00Z"):
+        limiter.acquire(1, max_wait=0)
+    # Other 403s are not rate limits
+    limiter.update(2, _response(403))
+    limiter.acquire(2, max_wait=0)
+
+
+@freeze_time("2022-05-01T12:00:00Z")
+@responses.activate
+def test_enrichment_is_skipped_when_budget_is_low(jobA_job):
+    responses.get(jobA_job["run_url"], json={}, headers=_rate_limit(10))
+    job = {**jobA_job, "head_branch": "main", "workflow_name": "Acceptance"}
+    client = GithubClient(dsn=None, token="token", installation_id=1)
+    # This feeds the budget
+    client._fetch_github(jobA_job["run_url"])
+    meta = client._get_extra_metadata(job)
+    assert len(responses.calls) == 1
+    assert meta["tags"]["workflow"] == "Acceptance"
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from configparser import ConfigParser
+
+from src.sampling import job_fields
+from src.sampling import Rules
+from src.sampling import run_fields
+from src.sampling import sample
+
+CONFIG = """
+[sentry-github-actions-app]
+dsn = https://foo@sentry.example.com/1
+
+[sentry-github-actions-app.rule.dependabot]
+workflow = dependabot*, Dependabot*
+sample_rate = 0
+
+[sentry-github-actions-app.rule.prs]
+repo = sentry
+event = pull_request
+sample_rate = 0.1
+
+[sentry-github-actions-app.rule.not-master]
+branch = !master
+sample_rate = 0.5
+
+[sentry-github-actions-app.rule.typo]
+wrokflow = foo
+"""
+
+
+def rules(workflow_run_mode=True):
+    cp = ConfigParser()
+    cp.read_string(CONFIG)
+    return Rules.from_config(cp, workflow_run_mode)
+
+
+def test_invalid_rules_are_ignored():
+    assert [rule.name for rule in rules().rules] == ["dependabot", "prs", "not-master"]
+
+
+def test_event_rules_are_ignored_for_jobs(caplog):
+    # Jobs do not know their event, thus, the rule would never match
+    assert [rule.name for rule in rules(workflow_run_mode=False).rules] == [
+        "dependabot",
+        "not-master",
+    ]
+    assert "Ignoring rule prs: ['event'] only apply in workflow_run mode" in caplog.text
+
+
+def test_first_matching_rule_decides(jobA_job):
+    fields = {**job_fields(jobA_job), "workflow": "Dependabot auto-merge"}
+    assert rules().keep(fields, "job:1") is False
+    # No rule matches
+    fields = {**job_fields(jobA_job), "branch": "master"}
+    assert rules().keep(fields, "job:1") is True
+    # Jobs do not know their event, thus, rules on it only apply to runs
+    assert job_fields(jobA_job)["event"] is None
+
+
+def test_sample_rate(jobA_runs):
+    fields = {**run_fields(jobA_runs), "repo": "sentry", "event": "pull_request"}
+    kept = sum(rules().keep(fields, f"run:{i}") for i in range(1000))
+    assert 50 < kept < 150
+
+
+def test_sampling_is_deterministic():
+    assert sample("job:1", 0.5) == sample("job:1", 0.5)
+    assert sample("job:1", 0) is False
+    assert sample("job:1", 1) is True
+
+
+def test_job_fields(jobA_job):
+    assert job_fields(jobA_job)["repo"] == "sentry"
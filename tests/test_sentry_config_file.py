@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import base64
 from unittest import TestCase
 
 import responses
+from freezegun import freeze_time
 
+from src.sentry_config import fetch_destinations_for_github_org
 from src.sentry_config import fetch_dsn_for_github_org
+from src.sentry_config import get_cached_rules
+from src.sentry_config import invalidate_dsn_cache
 from src.sentry_config import SENTRY_CONFIG_API_URL as api_url
 
 expected_dsn = (
@@ -47,6 +52,97 @@ class TestSentryConfigCase(TestCase):
     def test_fetch_parse_sentry_config_file(self) -> None:
         assert fetch_dsn_for_github_org(org, token) == expected_dsn
 
+    @responses.activate
+    def test_dsn_is_cached(self) -> None:
+        assert fetch_dsn_for_github_org(org, token) == expected_dsn
+        assert fetch_dsn_for_github_org(org, token) == expected_dsn
+        assert len(responses.calls) == 1
+
+    @responses.activate
+    def test_dsn_revalidated_with_etag(self) -> None:
+        responses.replace(
+            responses.GET,
+            self.api_url,
+            json=sentry_config_file_meta,
+            headers={"ETag": '"abc"'},
+        )
+        with freeze_time("2022-05-01T12:00:00Z"):
+            assert fetch_dsn_for_github_org(org, token) == expected_dsn
+
+        responses.replace(responses.GET, self.api_url, status=304)
+        # The TTL has passed, thus, we revalidate the cached DSN
+        with freeze_time("2022-05-01T13:00:00Z"):
+            assert fetch_dsn_for_github_org(org, token) == expected_dsn
+        assert responses.calls[1].request.headers["If-None-Match"] == '"abc"'
+
+    @responses.activate
+    def test_invalidate_dsn_cache(self) -> None:
+        fetch_dsn_for_github_org(org, token)
+        invalidate_dsn_cache(org)
+        fetch_dsn_for_github_org(org, token)
+        assert len(responses.calls) == 2
+
+    @responses.activate
+    def test_rules_are_cached_with_the_dsn(self) -> None:
+        config = f"""
+[sentry-github-actions-app]
+dsn = {expected_dsn}
+
+[sentry-github-actions-app.rule.dependabot]
+workflow = dependabot*
+"""
+        responses.replace(
+            responses.GET,
+            self.api_url,
+            json={
+                **sentry_config_file_meta,
+                "content": base64.b64encode(config.encode()).decode(),
+            },
+        )
+        assert get_cached_rules(org) is None
+        assert fetch_dsn_for_github_org(org, token) == expected_dsn
+        (rule,) = get_cached_rules(org).rules
+        assert rule.name == "dependabot"
+        assert rule.sample_rate == 0
+
+    @responses.activate
+    def test_destinations(self) -> None:
+        config = f"""
+[sentry-github-actions-app]
+dsn = {expected_dsn}
+
+[sentry-github-actions-app.destination.team-a]
+dsn = https://bar@o1.ingest.sentry.io/2
+repo = sentry, relay*
+
+[sentry-github-actions-app.destination.relay]
+dsn = http://baz@localhost:3000/3
+
+[sentry-github-actions-app.destination.typo]
+dns = https://bar@o1.ingest.sentry.io/4
+"""
+        responses.replace(
+            responses.GET,
+            self.api_url,
+            json={
+                **sentry_config_file_meta,
+                "content": base64.b64encode(config.encode()).decode(),
+            },
+        )
+        destinations = fetch_destinations_for_github_org(org, token)
+        assert destinations.for_repo("relay-tools") == [
+            expected_dsn,
+            "https://bar@o1.ingest.sentry.io/2",
+            "http://baz@localhost:3000/3",
+        ]
+        assert destinations.for_repo("snuba") == [
+            expected_dsn,
+            "http://baz@localhost:3000/3",
+        ]
+        # Both share the cached config
+        assert fetch_dsn_for_github_org(org, token) == expected_dsn
+        assert len(responses.calls) == 1
+
     def test_fetch_private_repo(self) -> None:
         pass
 
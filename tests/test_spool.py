@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import pytest
+import requests
+import responses
+from freezegun import freeze_time
+
+from src.spool import EnvelopeSpool
+from src.spool import get_retry_after
+
+URL = "https://random.ingest.sentry.io/api/bar/envelope/"
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return EnvelopeSpool(str(tmp_path / "spool.db"))
+
+
+def _response(status=200, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    return resp
+
+
+def test_get_retry_after():
+    assert get_retry_after(_response()) is None
+    assert get_retry_after(_response(429)) == 60
+    assert get_retry_after(_response(503, {"Retry-After": "30"})) == 30
+    assert (
+        get_retry_after(
+            _response(
+                429, {"X-Sentry-Rate-Limits": "60:transaction;error:org, 10:error:key"}
+            )
+        )
+        == 60
+    )
+    # Only errors are rate limited
+    assert (
+        get_retry_after(_response(200, {"X-Sentry-Rate-Limits": "60:error:key"}))
+        is None
+    )
+
+
+@responses.activate
+def test_drain_delivers_envelopes(spool):
+    responses.post(URL)
+    spool.add(URL, {"Content-Encoding": "gzip"}, b"body")
+    assert spool.drain() == 1
+    assert len(spool) == 0
+    assert responses.calls[0].request.body == b"body"
+    assert responses.calls[0].request.headers["Content-Encoding"] == "gzip"
+
+
+@responses.activate
+def test_drain_backs_off_on_server_errors(spool):
+    responses.post(URL, status=500)
+    with freeze_time("2022-05-01T12:00:00Z"):
+        spool.add(URL, {}, b"body")
+        assert spool.drain() == 0
+        # It is not due yet
+        assert spool.drain() == 0
+    assert len(responses.calls) == 1
+    assert len(spool) == 1
+
+    responses.replace(responses.POST, URL)
+    with freeze_time("2022-05-01T12:01:00Z"):
+        assert spool.drain() == 1
+    assert len(spool) == 0
+
+
+@responses.activate
+def test_drain_honours_rate_limits(spool):
+    responses.post(URL, status=429, headers={"Retry-After": "600"})
+    with freeze_time("2022-05-01T12:00:00Z"):
+        spool.add(URL, {}, b"first")
+        spool.add(URL, {}, b"second")
+        spool.drain()
+    # The second envelope was not sent once we were rate limited
+    assert len(responses.calls) == 1
+    assert spool.is_rate_limited(URL) is False
+
+    responses.replace(responses.POST, URL)
+    with freeze_time("2022-05-01T12:05:00Z"):
+        assert spool.drain() == 0
+        assert spool.is_rate_limited(URL)
+    with freeze_time("2022-05-01T12:10:01Z"):
+        assert spool.drain() == 2
+
+
+@responses.activate
+def test_drain_drops_rejected_envelopes(spool):
+    responses.post(URL, status=400)
+    spool.add(URL, {}, b"body")
+    assert spool.drain() == 0
+    assert len(spool) == 0
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from src.metrics import REGISTRY
+from src.startup import process_uptime
+from src.startup import StartupProfile
+
+
+def test_steps_are_recorded():
+    profile = StartupProfile()
+    with profile.step("handler"):
+        pass
+    profile.record("ready", 1.5)
+    # /proc may not be available (e.g. macOS)
+    profile.record("imports", None)
+    assert list(profile.durations) == ["handler", "ready"]
+    assert profile.samples()[("ready",)] == 1.5
+
+
+def test_process_uptime():
+    uptime = process_uptime()
+    assert uptime is None or uptime >= 0
+
+
+def test_startup_metrics():
+    assert "# TYPE gha_startup_duration_seconds gauge" in REGISTRY.render()
@@ -1,10 +1,16 @@
 from __future__ import annotations
 
+import base64
 import json
+import threading
 from unittest import mock
 
 import pytest
+import requests
 
+from src.sentry_config import _dsn_cache
+from src.sentry_config import CachedDsn
+from src.web_app_handler import parse_event
 from src.web_app_handler import WebAppHandler
 
 valid_signature = "d9259f51d3b64e7fe0cbe09d9b08b8ee763170d3521fecc35fd8b453be8cf6a5"
@@ -31,6 +37,18 @@ def test_invalid_github_event():
     assert http_code == 200
 
 
+@mock.patch("src.web_app_handler.invalidate_dsn_cache")
+def test_push_to_sentry_repo(mock_invalidate):
+    handler = WebAppHandler()
+    reason, http_code = handler.handle_event(
+        data={"repository": {"name": ".sentry", "owner": {"login": "getsentry"}}},
+        headers={"X-GitHub-Event": "push"},
+    )
+    assert reason == "Sentry config cache invalidated."
+    assert http_code == 200
+    mock_invalidate.assert_called_once_with("getsentry")
+
+
 def test_missing_action_key():
     handler = WebAppHandler()
     # This payload is missing the action key
@@ -108,3 +126,271 @@ def test_handle_event_with_secret(monkeypatch, webhook_event):
     )
     assert reason == "OK"
     assert http_code == 200
+
+
+def test_enrichment_fields_config(monkeypatch):
+    monkeypatch.setenv("GH_ENRICHMENT_FIELDS", "author, foo")
+    handler = WebAppHandler()
+    assert handler.config.enrichment_fields == frozenset({"author"})
+
+
+def test_handle_event_in_the_background(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    worker_pool = mock.Mock()
+    worker_pool.submit.return_value = True
+    handler = WebAppHandler(worker_pool=worker_pool)
+    payload = {**webhook_event["payload"], "installation": {"id": 1}}
+    reason, http_code = handler.handle_event(
+        data=payload,
+        headers=webhook_event["headers"],
+    )
+    assert (reason, http_code) == ("Accepted.", 202)
+    worker_pool.submit.assert_called_once_with(
+        handler.process_job,
+        1,
+        "armenzg",
+        payload["workflow_job"],
+        "99ba54a0-d21e-11ec-8158-e3ba791db828",
+        key=1,
+        on_drop=mock.ANY,
+    )
+
+    # The delivery can be redelivered if it is dropped from the queue
+    on_drop = worker_pool.submit.call_args.kwargs["on_drop"]
+    on_drop()
+    assert handler.seen_deliveries.get("99ba54a0-d21e-11ec-8158-e3ba791db828") is None
+    reason, http_code = handler.handle_event(
+        data=payload,
+        headers=webhook_event["headers"],
+    )
+    assert (reason, http_code) == ("Accepted.", 202)
+
+    # The delivery was already accepted
+    reason, http_code = handler.handle_event(
+        data=payload,
+        headers=webhook_event["headers"],
+    )
+    assert (reason, http_code) == ("Delivery already processed.", 200)
+
+    worker_pool.submit.return_value = False
+    handler.seen_deliveries.clear()
+    reason, http_code = handler.handle_event(
+        data=payload,
+        headers=webhook_event["headers"],
+    )
+    assert (reason, http_code) == ("Too many events queued.", 503)
+
+
+def test_failed_delivery_can_be_redelivered(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    handler = WebAppHandler()
+    payload = {**webhook_event["payload"], "installation": {"id": 1}}
+    with mock.patch.object(handler, "_get_client", side_effect=ValueError):
+        with pytest.raises(ValueError):
+            handler.handle_event(data=payload, headers=webhook_event["headers"])
+
+    with mock.patch.object(handler, "_get_client") as get_client:
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+        assert (reason, http_code) == ("OK", 200)
+        get_client.return_value.send_trace.assert_called_once()
+
+
+def test_installation_max_concurrency(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    handler = WebAppHandler(installation_max_concurrency=1)
+    payload = {**webhook_event["payload"], "installation": {"id": 1}}
+    responses = []
+
+    def send_trace(job):
+        # Another delivery of the same installation arrives while this one is processed
+        handler.seen_deliveries.clear()
+        responses.append(
+            handler.handle_event(data=payload, headers=webhook_event["headers"])
+        )
+
+    with mock.patch.object(handler, "_get_client") as get_client:
+        get_client.return_value.send_trace.side_effect = send_trace
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+    assert (reason, http_code) == ("OK", 200)
+    assert responses == [("Too many events of this installation in progress.", 503)]
+    # It can be redelivered
+    delivery_id = webhook_event["headers"]["X-GitHub-Delivery"]
+    assert handler.seen_deliveries.get(delivery_id) is None
+    assert handler._installation_inflight == {}
+
+
+def test_rejected_token_is_invalidated(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    handler = WebAppHandler()
+    handler.gh_app_token = mock.Mock()
+    payload = {**webhook_event["payload"], "installation": {"id": 1}}
+    rejected = requests.Response()
+    rejected.status_code = 401
+    rejected.url = (
+        "https://api.github.com/repos/armenzg/.sentry/contents/sentry_config.ini"
+    )
+    client = mock.Mock()
+
+    with mock.patch.object(
+        handler,
+        "_get_client",
+        side_effect=[requests.HTTPError(response=rejected), client],
+    ):
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+    assert (reason, http_code) == ("OK", 200)
+    handler.gh_app_token.invalidate.assert_called_once_with(1)
+    client.send_trace.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "event, body, expected",
+    [
+        ("check_run", b"", "Event not supported."),
+        (
+            "workflow_job",
+            b'{"action":"queued","workflow_job":{}}',
+            "We cannot do anything with this workflow state.",
+        ),
+        ("workflow_job", b'{"action":"completed","workflow_job":{}}', None),
+        # The action is not the first key, thus, the payload needs decoding
+        ("workflow_job", b'{"workflow_job":{},"action":"queued"}', None),
+        ("push", b'{"ref":"refs/heads/main"}', None),
+    ],
+)
+def test_ignore_reason(event, body, expected):
+    handler = WebAppHandler()
+    assert handler.ignore_reason({"X-GitHub-Event": event}, body) == expected
+
+
+def test_parse_event(webhook_event):
+    event = parse_event(json.dumps(webhook_event["payload"]).encode())
+    assert event == {
+        "action": "completed",
+        "repository": {"name": "sentry-hackweek", "owner": {"login": "armenzg"}},
+        "workflow_job": webhook_event["payload"]["workflow_job"],
+    }
+
+
+def test_workflow_run_mode(monkeypatch, jobA_runs):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    monkeypatch.setenv("WORKFLOW_RUN_MODE", "true")
+    handler = WebAppHandler()
+    # Jobs are ingested from their run, thus, job events are ignored
+    assert (
+        handler.ignore_reason({"X-GitHub-Event": "workflow_job"}, b"")
+        == "Event not supported."
+    )
+    assert (
+        handler.ignore_reason(
+            {"X-GitHub-Event": "workflow_run"}, b'{"action":"requested"}'
+        )
+        == "We cannot do anything with this workflow state."
+    )
+
+    payload = {
+        "action": "completed",
+        "installation": {"id": 1},
+        "repository": {"name": "sentry", "owner": {"login": "getsentry"}},
+        "workflow_run": jobA_runs,
+    }
+    with mock.patch.object(handler, "_get_client") as get_client:
+        reason, http_code = handler.handle_event(
+            data=payload, headers={"X-GitHub-Event": "workflow_run"}
+        )
+    assert (reason, http_code) == ("OK", 200)
+    get_client.return_value.send_workflow_run.assert_called_once_with(jobA_runs)
+
+
+def test_background_init(monkeypatch, private_key):
+    monkeypatch.setenv("GH_APP_ID", "1")
+    monkeypatch.setenv("GH_APP_PRIVATE_KEY", base64.b64encode(private_key).decode())
+    fetched = threading.Event()
+
+    def get_private_key():
+        # The handler is created before the key is loaded
+        fetched.wait(5)
+        return private_key
+
+    with mock.patch(
+        "src.web_app_handler.get_gh_app_private_key", side_effect=get_private_key
+    ), mock.patch("src.web_app_handler.http_client.warm") as warm:
+        handler = WebAppHandler(background_init=True)
+        assert not handler.ready.is_set()
+        assert handler.config.gh_app is None
+        # Settings from the environment are available right away
+        assert handler.trace_event == "workflow_job"
+
+        fetched.set()
+        assert handler.ready.wait(5)
+    assert handler.config.gh_app.app_id == "1"
+    assert handler.gh_app_token._jwt is not None
+    warm.assert_called_once_with("https://api.github.com")
+
+
+def test_events_wait_for_the_app_to_be_ready(monkeypatch):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    monkeypatch.setattr("src.web_app_handler.READY_TIMEOUT", 0)
+    handler = WebAppHandler()
+    handler.ready.clear()
+    with pytest.raises(TimeoutError):
+        handler._get_client(1, "getsentry")
+
+
+def test_sampling_rules(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    config = "[sentry-github-actions-app.rule.all]\nrepo = *\n"
+    handler = WebAppHandler()
+    payload = webhook_event["payload"]
+
+    # The org's config is not cached, thus, it is checked after fetching it
+    def get_client(installation_id, org, repo):
+        _dsn_cache.set(org, CachedDsn("https://foo@bar/1", None, config))
+        return client
+
+    client = mock.Mock()
+    with mock.patch.object(handler, "_get_client", side_effect=get_client):
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+    assert (reason, http_code) == ("OK", 200)
+    client.send_trace.assert_not_called()
+
+    # Now that the rules are cached the event is dropped before anything else
+    handler.seen_deliveries.clear()
+    with mock.patch.object(handler, "_get_client") as get_client:
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+    assert (reason, http_code) == ("Dropped by the org's sampling rules.", 200)
+    get_client.assert_not_called()
+
+
+def test_push_to_sentry_repo_updates_the_sampling_rules(monkeypatch, webhook_event):
+    monkeypatch.delenv("GH_APP_ID", raising=False)
+    handler = WebAppHandler()
+    payload = webhook_event["payload"]
+    org = payload["repository"]["owner"]["login"]
+    # This config drops every job
+    config = "[sentry-github-actions-app.rule.all]\nrepo = *\n"
+    _dsn_cache.set(org, CachedDsn("https://foo@bar/1", None, config))
+    reason, _ = handler.handle_event(data=payload, headers=webhook_event["headers"])
+    assert reason == "Dropped by the org's sampling rules."
+
+    # The org fixes its config
+    handler.handle_event(
+        data={"repository": {"name": ".sentry", "owner": {"login": org}}},
+        headers={"X-GitHub-Event": "push"},
+    )
+    client = mock.Mock()
+    with mock.patch.object(handler, "_get_client", return_value=client):
+        reason, http_code = handler.handle_event(
+            data=payload, headers=webhook_event["headers"]
+        )
+    assert (reason, http_code) == ("OK", 200)
+    client.send_trace.assert_called_once()
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from src.worker_pool import FairQueue
+from src.worker_pool import OVERFLOW_DROP_OLDEST
+from src.worker_pool import parse_weights
+from src.worker_pool import WorkerPool
+
+
+def test_submitted_work_is_processed():
+    pool = WorkerPool(size=2, queue_size=10)
+    results = []
+    for i in range(5):
+        assert pool.submit(results.append, i)
+    pool.shutdown()
+    assert sorted(results) == [0, 1, 2, 3, 4]
+
+
+def test_submit_when_queue_is_full():
+    pool = WorkerPool(size=1, queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    assert pool.submit(block)
+    started.wait()
+    # The only worker is busy and this fills the queue
+    assert pool.submit(lambda: None)
+    assert pool.submit(lambda: None) is False
+    release.set()
+    pool.shutdown()
+
+
+def test_submit_after_shutdown():
+    pool = WorkerPool(size=1, queue_size=1)
+    pool.shutdown()
+    assert pool.submit(lambda: None) is False
+
+
+def test_shutdown_timeout_is_for_the_whole_drain():
+    pool = WorkerPool(size=4, queue_size=10)
+    release = threading.Event()
+    for _ in range(4):
+        pool.submit(release.wait)
+    started = time.monotonic()
+    pool.shutdown(0.2)
+    assert time.monotonic() - started < 0.4
+    release.set()
+
+
+def test_errors_do_not_stop_workers():
+    pool = WorkerPool(size=1, queue_size=10)
+    results = []
+    pool.submit(lambda: 1 / 0)
+    pool.submit(results.append, "ok")
+    pool.shutdown()
+    assert results == ["ok"]
+
+
+def test_installations_are_served_fairly():
+    queue = FairQueue(maxsize=100, weights={"small": 2})
+    for i in range(6):
+        queue.put("large", i)
+    for i in range(4):
+        queue.put("small", i)
+    order = []
+    while queue.qsize():
+        key, _ = queue.get()
+        queue.task_done(key)
+        order.append(key)
+    # small has twice the weight; it does not wait for large's backlog
+    assert order[:6] == ["large", "small", "small", "large", "small", "small"]
+    # An installation showing up later does not wait for the backlog either
+    for i in range(3):
+        queue.put("large", i)
+    queue.put("new", 0)
+    assert [queue.get()[0] for _ in range(2)] == ["large", "new"]
+
+
+def test_concurrency_limit_per_installation():
+    queue = FairQueue(maxsize=100, max_concurrency=1)
+    queue.put("large", 1)
+    queue.put("large", 2)
+    queue.put("small", 1)
+    assert queue.get() == ("large", 1)
+    # large is at its limit, thus, small goes next even though large has a lower pass
+    assert queue.get() == ("small", 1)
+    queue.task_done("large")
+    assert queue.get() == ("large", 2)
+
+
+def test_overflow_reject():
+    queue = FairQueue(maxsize=3, key_maxsize=2)
+    assert queue.put("large", 1)
+    assert queue.put("large", 2)
+    assert queue.put("large", 3) is False
+    assert queue.put("small", 1)
+    assert queue.put("other", 1) is False
+
+
+def test_overflow_drop_oldest():
+    dropped = []
+    queue = FairQueue(
+        maxsize=3, key_maxsize=2, overflow=OVERFLOW_DROP_OLDEST, on_drop=dropped.append
+    )
+    assert queue.put("large", 1)
+    assert queue.put("large", 2)
+    assert queue.put("large", 3)
+    assert dropped == [1]
+    assert queue.put("small", 1)
+    # The queue is full; the installation with the largest backlog gives up an event
+    assert queue.put("other", 1)
+    assert dropped == [1, 2]
+    assert queue.qsize() == 3
+
+
+def test_dropped_events_are_reported():
+    pool = WorkerPool(size=1, queue_size=1, overflow=OVERFLOW_DROP_OLDEST)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    dropped = []
+    assert pool.submit(block, key=1)
+    started.wait()
+    assert pool.submit(lambda: None, key=1, on_drop=lambda: dropped.append(1))
+    assert pool.submit(lambda: None, key=2)
+    assert dropped == [1]
+    release.set()
+    pool.shutdown()
+
+
+def test_parse_weights():
+    assert parse_weights("12345:4, getsentry:0.5,") == {12345: 4.0, "getsentry": 0.5}